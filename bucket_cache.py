@@ -0,0 +1,180 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fsspec.implementations.cached import SimpleCacheFileSystem
+
+CACHE_FOLDER = "./bucket_cache/"
+CACHE_SIZE_LIMIT_GB = 4
+# once the limit is exceeded, files are evicted until the cache is below this fraction of it
+LOW_WATER_RATIO = 0.8
+INDEX_FILENAME = ".lru_index.json"
+
+
+class BucketCache:
+    """Size-bounded LRU bookkeeping of the files of an fsspec simplecache folder.
+
+    The size and last access time of the cached files are tracked on every open and kept in an index file in the
+    cache folder, so the folder is only scanned once at startup. As soon as the cache exceeds its size limit, the
+    least recently used files are removed until it is below the low-water mark, except for the pinned files in use.
+    """
+
+    def __init__(self, cache_folder=CACHE_FOLDER, size_limit_gb=CACHE_SIZE_LIMIT_GB, low_water_ratio=LOW_WATER_RATIO):
+        self.cache_folder = cache_folder
+        self.size_limit_bytes = size_limit_gb * 1024 ** 3
+        self.low_water_bytes = low_water_ratio * self.size_limit_bytes
+        self.index_file = os.path.join(cache_folder, INDEX_FILENAME)
+        self.lock = threading.Lock()
+        self.pinned = set()
+        self.pinning = False
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evicted = 0
+        os.makedirs(cache_folder, exist_ok=True)
+        # cached file name: [size, last access time]
+        self.entries = self.load_index()
+        self.total_size = sum(size for size, _ in self.entries.values())
+
+    def load_index(self):
+        entries = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                print(f"Ignoring unreadable cache index {self.index_file}")
+        # files added or removed outside of the index, e.g. by an interrupted run
+        with os.scandir(self.cache_folder) as dir_entries:
+            files = {entry.name: entry for entry in dir_entries if entry.is_file() and entry.name != INDEX_FILENAME
+                     and not entry.name.endswith(".tmp")}
+        entries = {name: entry for name, entry in entries.items() if name in files}
+        for name, dir_entry in files.items():
+            if name not in entries:
+                stat = dir_entry.stat()
+                entries[name] = [stat.st_size, stat.st_atime]
+        return entries
+
+    def save_index(self):
+        with self.lock:
+            entries = dict(self.entries)
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def get_filesystem(self, **kwargs):
+        # simplecache filesystem storing its files in the cache folder and reporting its opens to this cache
+        return LRUSimpleCacheFileSystem(bucket_cache=self, cache_storage=self.cache_folder, **kwargs)
+
+    def record_access(self, name, size, hit):
+        with self.lock:
+            if name in self.entries:
+                self.total_size -= self.entries[name][0]
+            self.entries[name] = [size, time.time()]
+            self.total_size += size
+            if hit:
+                self.n_hits += 1
+            else:
+                self.n_misses += 1
+            if self.pinning:
+                self.pinned.add(name)
+            if self.total_size > self.size_limit_bytes:
+                self._evict()
+
+    @contextmanager
+    def pin_accessed_files(self):
+        # files opened inside the context are not evicted before it ends, e.g. the files of the current Scene. The
+        # cache can exceed its limit while they are pinned
+        with self.lock:
+            self.pinning = True
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pinning = False
+                self.pinned = set()
+            self.evict()
+
+    def _evict(self):
+        # removes the least recently used files that are not pinned until the cache is below the low-water mark,
+        # must be called with the lock held
+        for name, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.total_size <= self.low_water_bytes:
+                break
+            if name in self.pinned:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_folder, name))
+            except FileNotFoundError:
+                pass
+            del self.entries[name]
+            self.total_size -= size
+            self.n_evicted += 1
+
+    def evict(self):
+        with self.lock:
+            if self.total_size > self.size_limit_bytes:
+                self._evict()
+        self.save_index()
+
+    def get_stats(self):
+        with self.lock:
+            n_opens = self.n_hits + self.n_misses
+            return {
+                'hits': self.n_hits,
+                'misses': self.n_misses,
+                'hit_rate': self.n_hits / n_opens if n_opens > 0 else None,
+                'evicted': self.n_evicted,
+                'n_files': len(self.entries),
+                'size_gb': self.total_size / 1024 ** 3,
+            }
+
+    def print_stats(self):
+        print_cache_stats(self.get_stats())
+
+
+def combine_stats(stats_list):
+    # stats of several caches, e.g. of the caches of parallel worker processes
+    stats = {key: sum(stats[key] for stats in stats_list) for key in ('hits', 'misses', 'evicted', 'n_files',
+                                                                       'size_gb')}
+    n_opens = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / n_opens if n_opens > 0 else None
+    return stats
+
+
+def print_cache_stats(stats):
+    hit_rate = f"{stats['hit_rate']:.0%}" if stats['hit_rate'] is not None else "n/a"
+    print(f"Bucket cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {hit_rate}), "
+          f"{stats['evicted']} files evicted, {stats['n_files']} files ({stats['size_gb']:.2f} GB) cached.")
+
+
+class LRUSimpleCacheFileSystem(SimpleCacheFileSystem):
+    """simplecache filesystem reporting the files it opens to a BucketCache."""
+
+    cachable = False
+
+    def __init__(self, bucket_cache, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket_cache = bucket_cache
+
+    def _open(self, path, mode="rb", **kwargs):
+        if "r" not in mode:
+            return super()._open(path, mode=mode, **kwargs)
+        hit = self._check_file(self._strip_protocol(path)) is not None
+        f = super()._open(path, mode=mode, **kwargs)
+        self.bucket_cache.record_access(os.path.basename(f.name), os.path.getsize(f.name), hit)
+        return f
@@ -0,0 +1,303 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+THROUGHPUT_REPORT_INTERVAL_S = 30
+DEFAULT_MAX_RETRIES = 5
+RETRY_BASE_DELAY_S = 2
+RETRY_MAX_DELAY_S = 300
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN_S = 60
+# HTTP statuses worth retrying, besides the server errors
+TRANSIENT_HTTP_STATUSES = (408, 429)
+
+
+class PermanentDownloadError(Exception):
+    """Raised by a download function for a failure that retrying cannot fix, e.g. a missing file or no access."""
+
+
+def is_transient_status(status):
+    # unknown statuses are retried
+    return status is None or status in TRANSIENT_HTTP_STATUSES or status >= 500
+
+
+def create_session(pool_size):
+    # one connection pool shared by all download threads, so that connections are kept alive between files
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class BandwidthLimiter:
+    """Limits the combined transfer rate of all threads reporting to it."""
+
+    def __init__(self, max_mb_per_s):
+        self.rate = max_mb_per_s * 1024 ** 2
+        self.lock = threading.Lock()
+        self.available_at = time.monotonic()
+
+    def consume(self, n_bytes):
+        # reserve the time slot needed to transfer n_bytes at the allowed rate and wait until it is over
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now) + n_bytes / self.rate
+            delay = self.available_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host after too many consecutive failures, for a cooldown period."""
+
+    def __init__(self, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, cooldown_s=CIRCUIT_BREAKER_COOLDOWN_S):
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self.lock = threading.Lock()
+        self.failures = Counter()
+        self.open_until = {}
+
+    def get_open_until(self, host):
+        # time until which the host should not be contacted, 0 if it can be
+        with self.lock:
+            return self.open_until.get(host, 0)
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures[host] = 0
+            self.open_until.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures[host] += 1
+            # once open, a single failure after the cooldown opens the breaker again
+            if self.failures[host] >= self.failure_threshold:
+                was_open = self.open_until.get(host, 0) > time.monotonic()
+                self.open_until[host] = time.monotonic() + self.cooldown_s
+                if not was_open:
+                    logger.warning(f"{self.failures[host]} consecutive failures for host {host}, "
+                                   f"pausing downloads from it for {self.cooldown_s} s.")
+
+
+def get_retry_delay(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
+
+
+class DownloadEngine:
+    """Runs download tasks on a pool of threads fed from a bounded priority queue.
+
+    The download function is called as download_function(task, session=..., progress_callback=...) and
+    must return True on success. All threads share one HTTP session and report the bytes they transfer,
+    which is used to log the live throughput and to apply the optional global bandwidth limit.
+
+    Tasks are submitted with a priority (lowest first) and a group, e.g. the collection id. group_limits
+    caps the number of concurrent downloads per group, the remaining threads take the next task of the other
+    groups. on_success is called with each task that was downloaded successfully.
+
+    Failed tasks are queued again after an exponential backoff with jitter, up to max_retries times. When
+    get_host is given, a circuit breaker per host pauses all tasks of a host after repeated failures. A download
+    function raising PermanentDownloadError fails the task at once, without counting towards the circuit breaker.
+    Tasks that could not be recovered are kept in failed_tasks. Any other exception stops the engine and is raised
+    again by submit and join.
+    """
+
+    def __init__(self, download_function, n_workers=4, max_queue_size=None, group_limits=None,
+                 max_mb_per_s=None, on_success=None, max_retries=DEFAULT_MAX_RETRIES, get_host=None,
+                 report_interval_s=THROUGHPUT_REPORT_INTERVAL_S):
+        self.download_function = download_function
+        self.on_success = on_success
+        self.n_workers = max(1, n_workers)
+        self.max_queue_size = max_queue_size or 4 * self.n_workers
+        self.group_limits = group_limits or {}
+        self.bandwidth_limiter = BandwidthLimiter(max_mb_per_s) if max_mb_per_s else None
+        self.report_interval_s = report_interval_s
+        self.session = create_session(self.n_workers)
+        self.max_retries = max_retries
+        self.get_host = get_host
+        self.circuit_breaker = CircuitBreaker()
+        # one heap of (priority, sequence, task, attempt) per group
+        self.pending = {}
+        self.n_pending = 0
+        # heap of (ready time, sequence, group, priority, task, attempt) waiting for a retry
+        self.delayed = []
+        self.failed_tasks = []
+        self.running = Counter()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.lock = threading.Lock()
+        self.threads = []
+        self.stopped = threading.Event()
+        self.n_bytes = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self.start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def start(self):
+        self.start_time = time.monotonic()
+        for _ in range(self.n_workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        reporter = threading.Thread(target=self._report_throughput, daemon=True)
+        reporter.start()
+
+    def submit(self, task, priority=0, group=None):
+        # blocks while the queue is full, so that tasks are produced at the pace they are downloaded
+        with self.condition:
+            while self.n_pending >= self.max_queue_size and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            heapq.heappush(self.pending.setdefault(group, []), (priority, next(self.sequence), task, 0))
+            self.n_pending += 1
+            self.condition.notify_all()
+
+    def _delay(self, group, priority, task, attempt, ready_time):
+        with self.condition:
+            heapq.heappush(self.delayed, (ready_time, next(self.sequence), group, priority, task, attempt))
+            self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.stopped.set()
+        self.session.close()
+        logger.info(f"Downloaded {self.n_done} files ({self.n_bytes / 1024 ** 2:.1f} MB) at "
+                    f"{self.get_throughput():.2f} MB/s, {self.n_failed} failed.")
+        if self.error is not None:
+            raise self.error
+
+    def add_bytes(self, n_bytes):
+        with self.lock:
+            self.n_bytes += n_bytes
+        if self.bandwidth_limiter is not None:
+            self.bandwidth_limiter.consume(n_bytes)
+
+    def get_throughput(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.n_bytes / 1024 ** 2 / elapsed if elapsed > 0 else 0.
+
+    def _next_task(self):
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    return None, None, None, None
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, sequence, group, priority, task, attempt = heapq.heappop(self.delayed)
+                    heapq.heappush(self.pending.setdefault(group, []), (priority, sequence, task, attempt))
+                    self.n_pending += 1
+
+                # None is a valid group, the tasks submitted without one
+                best_group = best_heap = None
+                for group, heap in self.pending.items():
+                    limit = self.group_limits.get(group)
+                    if not heap or (limit is not None and self.running[group] >= limit):
+                        continue
+                    if best_heap is None or heap[0] < best_heap[0]:
+                        best_group, best_heap = group, heap
+                if best_heap is not None:
+                    priority, _, task, attempt = heapq.heappop(self.pending[best_group])
+                    self.n_pending -= 1
+                    self.running[best_group] += 1
+                    self.condition.notify_all()
+                    return best_group, priority, task, attempt
+                # running tasks can still fail and come back for a retry
+                if self.closed and self.n_pending == 0 and not self.delayed and sum(self.running.values()) == 0:
+                    return None, None, None, None
+                self.condition.wait(timeout=self.delayed[0][0] - now if self.delayed else None)
+
+    def _worker(self):
+        while True:
+            group, priority, task, attempt = self._next_task()
+            if task is None:
+                return
+            host = self.get_host(task) if self.get_host is not None else None
+            open_until = self.circuit_breaker.get_open_until(host)
+            if open_until > time.monotonic():
+                # the host is down, try again once the cooldown is over without counting an attempt
+                self._delay(group, priority, task, attempt, open_until)
+                success = None
+            else:
+                try:
+                    success = self.download_function(task, session=self.session, progress_callback=self.add_bytes)
+                    if success and self.on_success is not None:
+                        self.on_success(task)
+                except PermanentDownloadError as error:
+                    logger.warning(f"Download of {task} failed permanently, not retrying it: {error}")
+                    with self.lock:
+                        self.n_failed += 1
+                        self.failed_tasks.append(task)
+                    success = None
+                except Exception as error:
+                    # a bug rather than a download failure, the remaining tasks are dropped and the error is raised
+                    # again by submit and join
+                    logger.error(f"Unexpected error while downloading {task}, stopping the downloads: {error!r}")
+                    with self.condition:
+                        if self.error is None:
+                            self.error = error
+                        self.condition.notify_all()
+                    success = None
+
+            if success:
+                self.circuit_breaker.record_success(host)
+                with self.lock:
+                    self.n_done += 1
+            elif success is not None:
+                self.circuit_breaker.record_failure(host)
+                if attempt < self.max_retries:
+                    delay = get_retry_delay(attempt)
+                    logger.info(f"Retrying failed download in {delay:.1f} s (attempt {attempt + 1} of "
+                                f"{self.max_retries}).")
+                    self._delay(group, priority, task, attempt + 1, time.monotonic() + delay)
+                else:
+                    with self.lock:
+                        self.n_failed += 1
+                        self.failed_tasks.append(task)
+            with self.condition:
+                self.running[group] -= 1
+                self.condition.notify_all()
+
+    def _report_throughput(self):
+        while not self.stopped.wait(self.report_interval_s):
+            logger.info(f"Download throughput: {self.get_throughput():.2f} MB/s, {self.n_done} files done, "
+                        f"{self.n_pending} queued, {len(self.delayed)} waiting for a retry.")
@@ -13,27 +13,63 @@
 
 import datetime
 import fnmatch
+import hashlib
 import os
-import shutil
-import tarfile
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
 from datetime import datetime, timedelta
-from multiprocessing import Pool
+from urllib.parse import urlparse
 
 import eumdac
 import requests
+import urllib3
+from eumdac.errors import eumdac_raise_for_status
 
+from download_engine import (DEFAULT_MAX_RETRIES, DownloadEngine, PermanentDownloadError, get_retry_delay,
+                             is_transient_status)
+from fci_filenames import FciEntryIndex
 from get_fci_chunks_for_area import get_chunks_for_lon_lat_bbox
 from logger import setup_logger
+from search_cache import SEARCH_CACHE_FOLDER, SearchCache
+from sync_journal import STATUS_DONE, STATUS_FAILED, STATUS_PENDING, SYNC_JOURNAL_FILENAME, SyncJournal
+from tools import TarArchiver
 
 
 logger = setup_logger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+DOWNLOAD_TIMEOUT_S = 60
+PARTIAL_FILE_SUFFIX = ".part"
+DEFAULT_N_PARALLEL_DOWNLOADS = 4
+DEFAULT_POLL_INTERVAL_S = 60
+PRIORITY_POLICIES = ["oldest_first", "newest_first", "fci_chunks_first", "round_robin"]
+DEFAULT_PRIORITY_POLICY = "oldest_first"
+# number of products whose entries are listed at the same time
+N_PREFETCH_THREADS = 16
+# attempts to list the entries of a product before it is skipped
+N_PREFETCH_ATTEMPTS = 3
+# bound of the download queue, planning pauses once it is full
+MAX_QUEUED_DOWNLOADS = 10000
+# run folder of the files shared by several AOIs
+DEFAULT_SHARED_RUN_NAME = "shared"
+# long searches are split into windows of this length, searched in parallel
+SEARCH_WINDOW = timedelta(days=1)
+N_SEARCH_THREADS = 8
+
 
 class EumdacDownloader:
-    def __init__(self, eumdac_key, eumdac_secret):
+    def __init__(self, eumdac_key, eumdac_secret, search_cache=None):
         self.datastore = self.initialise_datastore(eumdac_key, eumdac_secret)
+        self.search_cache = search_cache
         self.collections = {}
         self.output_folder_run = None
+        self.journal = None
+        self.archiver = None
         return
 
     def initialise_datastore(self, eumdac_key, eumdac_secret):
@@ -49,8 +85,60 @@ class EumdacDownloader:
         logger.debug("DataStore initialized.")
         return datastore
 
-    def search_products_for_collection(self, collection_id, start_time, end_time, search_bbox=None):
-        selected_collection = self.datastore.get_collection(collection_id)
+    def load_cached_search(self, collection_id, start_time, end_time, search_bbox):
+        record = self.search_cache.load(collection_id, start_time, end_time, search_bbox)
+        if record is None:
+            return None
+        if len(record['products']) > 0:
+            self.collections[collection_id] = {
+                'products': [self.datastore.get_product(collection_id, product_id)
+                             for product_id, _, _ in record['products']],
+                'product_type': record['product_type'],
+                'entries': {product_id: entries for product_id, entries, _ in record['products'] if entries is not None},
+                'sensing_starts': {product_id: datetime.strptime(sensing_start, "%Y-%m-%dT%H:%M:%S.%f")
+                                   for product_id, _, sensing_start in record['products'] if sensing_start is not None},
+                'bboxes': {},
+                'unlisted': set(),
+                'search': (start_time, end_time, search_bbox, record['saved_at'])
+            }
+        logger.info(f"Loaded {len(record['products'])} products for collection_id {collection_id} "
+                    f"from the search cache.")
+        return len(record['products'])
+
+    def save_search_cache(self, collection_id):
+        if self.search_cache is None or collection_id not in self.collections:
+            return
+        collection = self.collections[collection_id]
+        if collection['search'] is None:
+            return
+        start_time, end_time, search_bbox, saved_at = collection['search']
+        product_entries = []
+        for product in collection['products']:
+            sensing_start = collection['sensing_starts'].get(str(product))
+            product_entries.append([str(product), collection['entries'].get(str(product)),
+                                    sensing_start.strftime("%Y-%m-%dT%H:%M:%S.%f") if sensing_start else None])
+        self.search_cache.save(collection_id, start_time, end_time, search_bbox, collection['product_type'],
+                               product_entries, saved_at=saved_at)
+
+    def get_product_entries(self, collection_id, product):
+        # product.entries is a remote call, so the entries are kept (and cached on disk) once listed
+        entries = self.collections[collection_id]['entries']
+        product_id = str(product)
+        if product_id not in entries:
+            entries[product_id] = list(product.entries)
+        return entries[product_id]
+
+    def search_window(self, selected_collection, start_time, end_time, search_bbox=None):
+        return list(selected_collection.search(bbox=search_bbox, dtstart=start_time, dtend=end_time))
+
+    def iter_search_results(self, collection_id, start_time, end_time, search_bbox=None,
+                            refresh_search_cache=False, search_window=SEARCH_WINDOW):
+        # yields the products found for the time range, long ranges are split into sub-windows that are searched
+        # in parallel and the products of each sub-window are yielded as soon as it returns
+        if self.search_cache is not None and not refresh_search_cache:
+            if self.load_cached_search(collection_id, start_time, end_time, search_bbox) is not None:
+                yield from self.collections.get(collection_id, {}).get('products', [])
+                return
 
         start_time_coll = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S")
         end_time_coll = datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%S")
@@ -58,123 +146,498 @@ class EumdacDownloader:
         if start_time_coll > end_time_coll:
             raise ValueError(f"Start time {start_time} is after end time {end_time}.")
 
+        selected_collection = self.datastore.get_collection(collection_id)
         # Retrieve datasets that match the filter
         if search_bbox is not None:
             logger.info(f"Searching for products in area {search_bbox}")
-        products = selected_collection.search(
-            bbox=search_bbox,
-            dtstart=start_time_coll,
-            dtend=end_time_coll)
+        windows = split_time_range(start_time_coll, end_time_coll, search_window)
+        if len(windows) > 1:
+            logger.info(f"Searching collection_id {collection_id} in {len(windows)} windows of {search_window}.")
 
-        if len(products) > 0:
-            # note: we go this way instead of querying selected_collection.product_type since that is super slow
-            product_type = products.first().product_type
-            if '2' in product_type:
-                # add and remove one second to avoid retrieval of too many L2 products
-                start_time_coll += timedelta(seconds=1)
-                end_time_coll -= timedelta(seconds=1)
-
-                products = selected_collection.search(
-                    dtstart=start_time_coll,
-                    dtend=end_time_coll,
-                    bbox=search_bbox)
-                logger.info(
-                    f"Found {len(products)} products for collection_id {collection_id} with type {product_type} and time range {start_time_coll} to {end_time_coll} (adjusted for L2).")
-            else:
-                logger.info(
-                    f"Found {len(products)} products for collection_id {collection_id} with type {product_type} and time range {start_time_coll} to {end_time_coll}.")
+        collection = {
+            'products': [],
+            'product_type': None,
+            'entries': {},
+            'sensing_starts': {},
+            'bboxes': {},
+            'unlisted': set(),
+            'search': (start_time, end_time, search_bbox, time.time())
+        }
+        product_ids = set()
+        with ThreadPoolExecutor(max_workers=N_SEARCH_THREADS) as executor:
+            futures = [executor.submit(self.search_window, selected_collection, window_start, window_end, search_bbox)
+                       for window_start, window_end in windows]
+            for future in as_completed(futures):
+                for product in future.result():
+                    # products overlapping two windows are found in both
+                    if str(product) in product_ids:
+                        continue
+                    if collection['product_type'] is None:
+                        # note: we go this way instead of querying selected_collection.product_type since that is
+                        # super slow
+                        collection['product_type'] = product.product_type
+                        self.collections[collection_id] = collection
+                    if '2' in collection['product_type'] and not (
+                            product.sensing_end >= start_time_coll + timedelta(seconds=1) and
+                            product.sensing_start <= end_time_coll - timedelta(seconds=1)):
+                        # skip the L2 products only touching the time range, same as searching with one second
+                        # added to the start and removed from the end
+                        continue
+                    product_ids.add(str(product))
+                    collection['products'].append(product)
+                    yield product
 
-            self.collections[collection_id] = {
-                'products': products,
-                'product_type': product_type
-            }
+        if len(collection['products']) > 0:
+            # newest first, as returned by a single search
+            collection['products'].sort(key=lambda product: product.sensing_start, reverse=True)
+            logger.info(
+                f"Found {len(collection['products'])} products for collection_id {collection_id} with type {collection['product_type']} and time range {start_time_coll} to {end_time_coll}.")
+            self.save_search_cache(collection_id)
         else:
+            self.collections.pop(collection_id, None)
             logger.info(
                 f"No products found for collection_id {collection_id} and time range {start_time_coll} to {end_time_coll}.")
+            if self.search_cache is not None:
+                self.search_cache.save(collection_id, start_time, end_time, search_bbox, None, [])
 
-        return len(products)
+    def search_products_for_collection(self, collection_id, start_time, end_time, search_bbox=None,
+                                       refresh_search_cache=False):
+        return sum(1 for _ in self.iter_search_results(collection_id, start_time, end_time, search_bbox=search_bbox,
+                                                       refresh_search_cache=refresh_search_cache))
 
-    def search_products_for_collections(self, collection_ids, start_time, end_time, search_bbox=None):
+    def search_products_for_collections(self, collection_ids, start_time, end_time, search_bbox=None,
+                                        refresh_search_cache=False):
         for collection_id in collection_ids:
-            self.search_products_for_collection(collection_id, start_time, end_time, search_bbox=search_bbox)
+            self.search_products_for_collection(collection_id, start_time, end_time, search_bbox=search_bbox,
+                                                refresh_search_cache=refresh_search_cache)
 
-    def download_products_for_collection(self, collection_id, output_folder, run_name, file_endings, fci_l1c_chunks_lonlat_bbox=None,
-                                         n_parallel_downloads=None):
-        if collection_id not in self.collections:
-            logger.info(f"Collection {collection_id} not found in the retrieved collections.")
-            return
+    def search_new_products_for_collection(self, collection_id, high_water_mark, end_time, search_bbox=None):
+        # only products with a sensing start after the high-water mark are kept, the search itself
+        # also returns the products overlapping with it
+        selected_collection = self.datastore.get_collection(collection_id)
+        products = [product for product in selected_collection.search(bbox=search_bbox, dtstart=high_water_mark,
+                                                                      dtend=end_time)
+                    if product.sensing_start > high_water_mark]
+        if len(products) > 0:
+            logger.info(f"Found {len(products)} new products for collection_id {collection_id} "
+                        f"since {high_water_mark}.")
+            self.collections[collection_id] = {
+                'products': products,
+                'product_type': products[0].product_type,
+                'entries': {},
+                'sensing_starts': {},
+                'bboxes': {},
+                'unlisted': set(),
+                'search': None
+            }
+        else:
+            self.collections.pop(collection_id, None)
+        return len(products)
 
+    def update_high_water_mark(self, collection_id, default=None):
+        journal = self.get_journal()
+        high_water_mark = journal.get_high_water_mark(collection_id) or default
+        if collection_id in self.collections:
+            sensing_starts = [self.get_product_sensing_start(collection_id, product)
+                              for product in self.collections[collection_id]['products']]
+            newest = max(sensing_starts)
+            # the mark stops just before the oldest product with failed entries, so that the next polls
+            # (or a restart) search it again and retry its missing entries
+            failed_product_ids = {row[1] for row in journal.get_failed_entries(collection_id)}
+            failed_product_ids |= self.collections[collection_id]['unlisted']
+            failed_starts = [sensing_start for product, sensing_start
+                             in zip(self.collections[collection_id]['products'], sensing_starts)
+                             if str(product) in failed_product_ids]
+            if len(failed_starts) > 0:
+                newest = min(newest, min(failed_starts) - timedelta(microseconds=1))
+            if high_water_mark is None or newest > high_water_mark:
+                high_water_mark = newest
+        if high_water_mark is not None:
+            journal.set_high_water_mark(collection_id, high_water_mark)
+        return high_water_mark
+
+    def follow_collections(self, collection_ids, start_time, end_time, output_folder, run_name, file_endings,
+                           fci_l1c_chunks_lonlat_bbox=None, search_bbox=None, n_parallel_downloads=None,
+                           poll_interval_s=DEFAULT_POLL_INTERVAL_S, priority_policy="newest_first",
+                           max_mb_per_s=None, max_retries=DEFAULT_MAX_RETRIES):
         self.output_folder_run = os.path.join(output_folder, run_name)
         os.makedirs(self.output_folder_run, exist_ok=True)
+        start_time_coll = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S")
+        end_time_coll = datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%S") if end_time is not None else None
+        for collection_id in collection_ids:
+            # products starting exactly at start_time are newer than the initial high-water mark
+            self.update_high_water_mark(collection_id, default=start_time_coll - timedelta(microseconds=1))
 
-        download_tasks = []
+        logger.info(f"Following collections {collection_ids}, polling every {poll_interval_s} s.")
+        while True:
+            poll_start = time.monotonic()
+            now = datetime.utcnow()
+            search_end = now if end_time_coll is None else min(now, end_time_coll)
+            new_collection_ids = [
+                collection_id for collection_id in collection_ids
+                if self.search_new_products_for_collection(
+                    collection_id, self.get_journal().get_high_water_mark(collection_id), search_end, search_bbox) > 0]
+            if len(new_collection_ids) > 0:
+                self.download_products_for_collections(new_collection_ids, output_folder, run_name, file_endings,
+                                                       fci_l1c_chunks_lonlat_bbox,
+                                                       n_parallel_downloads=n_parallel_downloads,
+                                                       priority_policy=priority_policy, max_mb_per_s=max_mb_per_s,
+                                                       max_retries=max_retries)
+                for collection_id in new_collection_ids:
+                    self.update_high_water_mark(collection_id)
+            if end_time_coll is not None and now >= end_time_coll:
+                logger.info(f"Reached end time {end_time}, stop following collections.")
+                return
+            time.sleep(max(0., poll_interval_s - (time.monotonic() - poll_start)))
+
+    def get_journal(self):
+        if self.journal is None or self.journal.db_path != os.path.join(self.output_folder_run,
+                                                                         SYNC_JOURNAL_FILENAME):
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = SyncJournal.for_run_folder(self.output_folder_run)
+        return self.journal
+
+    def is_entry_done(self, collection_id, product, entry, output_file, done_entries):
+        # the journal is checked first, entries it marks done only need a stat of their file. Files deleted or
+        # truncated since are downloaded again
+        if (str(product), entry) in done_entries:
+            size = done_entries[(str(product), entry)]
+            if os.path.exists(output_file) and (size is None or os.path.getsize(output_file) == size):
+                return True
+            logger.info(f"File {output_file} is missing or changed since it was downloaded, downloading it again.")
+            self.journal.record(collection_id, str(product), entry, output_file, STATUS_PENDING)
+            return False
+        if os.path.exists(output_file):
+            # downloaded before the journal existed
+            self.journal.record(collection_id, str(product), entry, output_file, STATUS_DONE,
+                                size=os.path.getsize(output_file))
+            return True
+        return False
 
-        if 'FCI1C' in self.collections[collection_id]['product_type']:
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def get_product_sensing_start(self, collection_id, product):
+        sensing_starts = self.collections[collection_id]['sensing_starts']
+        product_id = str(product)
+        if product_id not in sensing_starts:
+            sensing_starts[product_id] = product.sensing_start
+        return sensing_starts[product_id]
+
+    def get_product_lonlat_bbox(self, collection_id, product):
+        # bbox of the footprint of a product, product.metadata is a remote call
+        bboxes = self.collections[collection_id]['bboxes']
+        product_id = str(product)
+        if product_id not in bboxes:
+            bboxes[product_id] = get_product_bbox(product)
+        return bboxes[product_id]
+
+    def get_chunks_list(self, collection_id, fci_l1c_chunks_lonlat_bbox):
+        # chunks to download for FCI L1c collections, None for all other collections. The bbox can also be a list
+        # of bboxes, downloading the chunks of all of them
+        if 'FCI1C' not in self.collections[collection_id]['product_type']:
+            return None
+        if fci_l1c_chunks_lonlat_bbox is not None and isinstance(fci_l1c_chunks_lonlat_bbox[0], (list, tuple)):
+            chunks_list = sorted(set(chunk for lonlat_bbox in fci_l1c_chunks_lonlat_bbox
+                                     for chunk in get_chunks_for_lon_lat_bbox(lonlat_bbox)))
+        else:
             chunks_list = get_chunks_for_lon_lat_bbox(fci_l1c_chunks_lonlat_bbox)
-            if fci_l1c_chunks_lonlat_bbox is None:
-                logger.info(f"No fci_l1c_chunks_lonlat_bbox provided, will retrieve all chunks.")
-            else:
-                logger.info(f"Will be retrieving chunks: {chunks_list}")
-
-            for product in self.collections[collection_id]['products']:
-                for entry_filename in filter_chunks(chunks_list, product.entries):
-                    output_file = os.path.join(self.output_folder_run, entry_filename)
-                    if os.path.exists(output_file):
-                        logger.info(f'File {output_file} already exists, skipping download.')
-                    else:
-                        download_tasks.append((product, entry_filename, output_file))
+        if fci_l1c_chunks_lonlat_bbox is None:
+            logger.info(f"No fci_l1c_chunks_lonlat_bbox provided, will retrieve all chunks.")
         else:
-            for product in self.collections[collection_id]['products']:
-                for entry_filename in product.entries:
-                    if file_endings is not None and not entry_filename.endswith(tuple(file_endings)):
+            logger.info(f"Will be retrieving chunks: {chunks_list}")
+        return chunks_list
+
+    def prefetch_product(self, collection_id, product, prefetch_bbox=False):
+        # runs in the prefetch threads, product.entries and the product properties are remote calls. The footprint
+        # is only needed to select the products of other than FCI L1c collections by AOI
+        for attempt in range(N_PREFETCH_ATTEMPTS):
+            try:
+                self.get_product_entries(collection_id, product)
+                self.get_product_sensing_start(collection_id, product)
+                if prefetch_bbox and 'FCI1C' not in product.product_type:
+                    self.get_product_lonlat_bbox(collection_id, product)
+                return
+            except Exception as error:
+                if attempt == N_PREFETCH_ATTEMPTS - 1:
+                    raise
+                logger.info(f"Could not list product {product} of collection {collection_id}, retrying: {error}")
+                time.sleep(get_retry_delay(attempt))
+
+    def iter_prefetched_products(self, product_sources, n_threads=N_PREFETCH_THREADS, prefetch_bboxes=False):
+        # product_sources holds an iterable of products per collection id, e.g. the results of a running search.
+        # Yields (collection id, product) as soon as the entries of the product are known, the sources are read at
+        # the same time and the entries of their products are listed in parallel
+        results = queue.Queue()
+
+        def put_result(collection_id, product, future):
+            results.put((collection_id, product, future))
+
+        def feed(collection_id, products):
+            # puts (collection id, product, future) on the results queue when a product is done, and the number of
+            # products once the source is exhausted
+            n_products = 0
+            try:
+                for product in products:
+                    executor.submit(self.prefetch_product, collection_id, product, prefetch_bboxes).add_done_callback(
+                        partial(put_result, collection_id, product))
+                    n_products += 1
+            except Exception as error:
+                results.put(error)
+            results.put(n_products)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for collection_id, products in product_sources.items():
+                threading.Thread(target=feed, args=(collection_id, products), daemon=True).start()
+            n_feeding = len(product_sources)
+            n_submitted = 0
+            n_done = 0
+            while n_feeding > 0 or n_done < n_submitted:
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                if isinstance(result, int):
+                    n_feeding -= 1
+                    n_submitted += result
+                else:
+                    n_done += 1
+                    collection_id, product, future = result
+                    if future.exception() is not None:
+                        # the other products go on, the product is planned again by the next run or poll
+                        logger.warning(f"Could not list product {product} of collection {collection_id}, "
+                                       f"skipping it: {future.exception()}")
+                        self.collections[collection_id]['unlisted'].add(str(product))
                         continue
-                    # cannot check the product.format as it takes forever to get (?)
-                    if ".SEN" in entry_filename:
-                        out_folder = os.path.join(self.output_folder_run,
-                                                  "".join(entry_filename.split('/')[:-1]))
-                        output_file = os.path.join(out_folder, entry_filename.split('/')[-1])
-                    else:
-                        out_folder = self.output_folder_run
-                        output_file = os.path.join(out_folder, entry_filename)
-
-                    os.makedirs(out_folder, exist_ok=True)
-
-                    if os.path.exists(output_file):
-                        logger.info(f'File already exists, skipping download: {output_file}')
-                    else:
-                        download_tasks.append((product, entry_filename, output_file))
-
-        if len(download_tasks) > 0:
-            logger.info(f"Starting download of {len(download_tasks)} files for collection {collection_id}.")
-            # start with older data
-            download_tasks = reversed(download_tasks)
-            if n_parallel_downloads > 1:
-                logger.info(f"Starting {n_parallel_downloads} parallel downloads.")
-                with Pool(n_parallel_downloads) as pool:
-                    pool.map(download_file, download_tasks)
-            else:
-                logger.info(f"Starting single-threaded download.")
-                for task in download_tasks:
-                    download_file(task)
+                    yield collection_id, product
+
+    def plan_downloads_for_product(self, collection_id, product, file_endings, chunks_list, is_fci_chunk,
+                                   done_entries, aoi_bboxes=None):
+        # returns the download tasks of a product not done yet, as (sensing start, is an FCI chunk, task) tuples,
+        # and the number of entries that were downloaded already. Products of other than FCI L1c collections are
+        # skipped if their footprint misses all aoi_bboxes
+        if chunks_list is None and aoi_bboxes is not None:
+            product_bbox = self.get_product_lonlat_bbox(collection_id, product)
+            # products without a footprint are needed by all AOIs
+            if product_bbox is not None and not any(bboxes_intersect(product_bbox, aoi_bbox)
+                                                    for aoi_bbox in aoi_bboxes):
+                return [], 0
+        entries = self.get_product_entries(collection_id, product)
+        if chunks_list is not None:
+            selected = [(entry.name, os.path.join(self.output_folder_run, entry.name))
+                        for entry in FciEntryIndex(entries).select(chunks_list)]
         else:
-            logger.info(f"No files to download for collection {collection_id}.")
+            selected = []
+            for entry_filename in entries:
+                if file_endings is not None and not entry_filename.endswith(tuple(file_endings)):
+                    continue
+                out_folder, output_file = get_output_file_for_entry(self.output_folder_run, entry_filename)
+                os.makedirs(out_folder, exist_ok=True)
+                selected.append((entry_filename, output_file))
 
-        return
+        download_tasks = []
+        n_skipped = 0
+        sensing_start = self.get_product_sensing_start(collection_id, product)
+        for entry_filename, output_file in selected:
+            if self.is_entry_done(collection_id, product, entry_filename, output_file, done_entries):
+                n_skipped += 1
+            else:
+                download_tasks.append((sensing_start, is_fci_chunk, (product, entry_filename, output_file)))
+        return download_tasks, n_skipped
+
+    def iter_download_tasks(self, product_sources, output_folder, run_name, file_endings,
+                            fci_l1c_chunks_lonlat_bbox=None, aoi_bboxes=None):
+        # yields (collection id, (sensing start, is an FCI chunk, task)) for the entries not done yet, product by
+        # product as soon as their entries are listed
+        self.output_folder_run = os.path.join(output_folder, run_name)
+        os.makedirs(self.output_folder_run, exist_ok=True)
+        journal = self.get_journal()
+
+        chunks_lists = {}
+        done_entries = {collection_id: journal.get_done_entries(collection_id) for collection_id in product_sources}
+        n_planned = Counter()
+        n_skipped = Counter()
+        for collection_id, product in self.iter_prefetched_products(product_sources,
+                                                                    prefetch_bboxes=aoi_bboxes is not None):
+            if collection_id not in chunks_lists:
+                # the product type of a collection is known once its first product was found
+                chunks_lists[collection_id] = self.get_chunks_list(collection_id, fci_l1c_chunks_lonlat_bbox)
+            chunks_list = chunks_lists[collection_id]
+            download_tasks, n_skipped_product = self.plan_downloads_for_product(
+                collection_id, product, file_endings, chunks_list, chunks_list is not None,
+                done_entries[collection_id], aoi_bboxes=aoi_bboxes)
+            n_planned[collection_id] += len(download_tasks)
+            n_skipped[collection_id] += n_skipped_product
+            for download_task in download_tasks:
+                yield collection_id, download_task
+
+        for collection_id in product_sources:
+            if collection_id not in self.collections:
+                continue
+            self.save_search_cache(collection_id)
+            if n_skipped[collection_id] > 0:
+                logger.info(f"Skipping {n_skipped[collection_id]} files of collection {collection_id} that were "
+                            f"already downloaded.")
+            logger.info(f"Planned {n_planned[collection_id]} downloads for collection {collection_id}.")
+
+    def run_downloads(self, product_sources, output_folder, run_name, file_endings, fci_l1c_chunks_lonlat_bbox=None,
+                      n_parallel_downloads=None, priority_policy=DEFAULT_PRIORITY_POLICY, max_mb_per_s=None,
+                      max_retries=DEFAULT_MAX_RETRIES, aoi_bboxes=None):
+        # product_sources holds an iterable of products per collection id. All collections are downloaded at the
+        # same time, downloads start while the remaining products are still being searched and listed. With
+        # aoi_bboxes, only the products of other than FCI L1c collections overlapping one of them are downloaded
+        if priority_policy not in PRIORITY_POLICIES:
+            raise ValueError(f"Unknown priority policy {priority_policy}, choose from {PRIORITY_POLICIES}.")
+        if len(product_sources) == 0:
+            logger.info(f"No files to download.")
+            return
+
+        collection_ids = list(product_sources)
+        group_limits = {collection_id: get_n_parallel_downloads(n_parallel_downloads, collection_id)
+                        for collection_id in collection_ids}
+        for collection_id in collection_ids:
+            logger.info(f"Starting download for collection {collection_id} "
+                        f"with {group_limits[collection_id]} parallel downloads.")
+
+        self.output_folder_run = os.path.join(output_folder, run_name)
+        os.makedirs(self.output_folder_run, exist_ok=True)
+        journal = self.get_journal()
+        task_indices = Counter()
+        with DownloadEngine(partial(download_file, journal=journal), sum(group_limits.values()),
+                            max_queue_size=MAX_QUEUED_DOWNLOADS, group_limits=group_limits, max_mb_per_s=max_mb_per_s,
+                            on_success=self.archive_downloaded_file if self.archiver is not None else None,
+                            max_retries=max_retries, get_host=get_task_host) as engine:
+            for collection_id, (sensing_start, is_fci_chunk, task) in self.iter_download_tasks(
+                    product_sources, output_folder, run_name, file_endings, fci_l1c_chunks_lonlat_bbox,
+                    aoi_bboxes=aoi_bboxes):
+                priority = get_task_priority(priority_policy, sensing_start, is_fci_chunk,
+                                             collection_ids.index(collection_id), task_indices[collection_id])
+                task_indices[collection_id] += 1
+                engine.submit(task, priority=priority, group=collection_id)
+
+        for collection_id in collection_ids:
+            if collection_id in self.collections:
+                journal.log_throughput_report(collection_id)
+        if len(engine.failed_tasks) > 0:
+            logger.warning(f"Could not download {len(engine.failed_tasks)} files after {max_retries} retries:")
+            for _, _, output_file in engine.failed_tasks:
+                logger.warning(f"  {output_file}")
+
+    def archive_downloaded_file(self, task):
+        _, _, output_file = task
+        self.archiver.add(output_file)
+
+    def download_products_for_collection(self, collection_id, output_folder, run_name, file_endings,
+                                         fci_l1c_chunks_lonlat_bbox=None, n_parallel_downloads=None,
+                                         priority_policy=DEFAULT_PRIORITY_POLICY, max_mb_per_s=None,
+                                         max_retries=DEFAULT_MAX_RETRIES):
+        self.download_products_for_collections([collection_id], output_folder, run_name, file_endings,
+                                               fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox,
+                                               n_parallel_downloads=n_parallel_downloads,
+                                               priority_policy=priority_policy, max_mb_per_s=max_mb_per_s,
+                                               max_retries=max_retries)
 
     def download_products_for_collections(self, collection_ids, output_folder, run_name, file_endings,
-                                          fci_l1c_chunks_lonlat_bbox=None, n_parallel_downloads=None):
+                                          fci_l1c_chunks_lonlat_bbox=None, n_parallel_downloads=None,
+                                          priority_policy=DEFAULT_PRIORITY_POLICY, max_mb_per_s=None,
+                                          max_retries=DEFAULT_MAX_RETRIES):
+        product_sources = {}
         for collection_id in collection_ids:
-            self.download_products_for_collection(collection_id, output_folder, run_name, file_endings, fci_l1c_chunks_lonlat_bbox,
-                                                  n_parallel_downloads=n_parallel_downloads)
+            if collection_id not in self.collections:
+                logger.info(f"Collection {collection_id} not found in the retrieved collections.")
+                continue
+            products = self.collections[collection_id]['products']
+            # searches return the newest products first
+            product_sources[collection_id] = products[::-1] if priority_policy == "oldest_first" else products
+        self.run_downloads(product_sources, output_folder, run_name, file_endings,
+                           fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox,
+                           n_parallel_downloads=n_parallel_downloads, priority_policy=priority_policy,
+                           max_mb_per_s=max_mb_per_s, max_retries=max_retries)
+
+    def search_and_download_products_for_collections(self, collection_ids, start_time, end_time, output_folder,
+                                                     run_name, file_endings, fci_l1c_chunks_lonlat_bbox=None,
+                                                     search_bbox=None, refresh_search_cache=False,
+                                                     n_parallel_downloads=None,
+                                                     priority_policy=DEFAULT_PRIORITY_POLICY, max_mb_per_s=None,
+                                                     max_retries=DEFAULT_MAX_RETRIES, aoi_bboxes=None):
+        # the products of each search window are downloaded as soon as the window has been searched
+        product_sources = {collection_id: self.iter_search_results(collection_id, start_time, end_time,
+                                                                   search_bbox=search_bbox,
+                                                                   refresh_search_cache=refresh_search_cache)
+                           for collection_id in collection_ids}
+        self.run_downloads(product_sources, output_folder, run_name, file_endings,
+                           fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox,
+                           n_parallel_downloads=n_parallel_downloads, priority_policy=priority_policy,
+                           max_mb_per_s=max_mb_per_s, max_retries=max_retries, aoi_bboxes=aoi_bboxes)
 
-    def create_tarball(self, output_folder, run_name):
+    def link_downloads_to_aois(self, collection_ids, aois, output_folder, shared_run_name, file_endings):
+        # links the downloaded files of the shared store into the run folder of each AOI that needs them. FCI L1c
+        # files are selected by chunk, the other products by the bbox of their footprint
+        shared_run_folder = os.path.join(output_folder, shared_run_name)
+        n_links = Counter()
+        for collection_id in collection_ids:
+            if collection_id not in self.collections:
+                continue
+            products = self.collections[collection_id]['products']
+            if 'FCI1C' in self.collections[collection_id]['product_type']:
+                entry_index = FciEntryIndex()
+                for product in products:
+                    entry_index.add(self.get_product_entries(collection_id, product), product=product)
+                for aoi_name, lonlat_bbox in aois.items():
+                    aoi_run_folder = os.path.join(output_folder, aoi_name)
+                    os.makedirs(aoi_run_folder, exist_ok=True)
+                    for entry in entry_index.select(get_chunks_for_lon_lat_bbox(lonlat_bbox)):
+                        n_links[aoi_name] += link_file(os.path.join(shared_run_folder, entry.name),
+                                                       os.path.join(aoi_run_folder, entry.name))
+                continue
+
+            with ThreadPoolExecutor(max_workers=N_PREFETCH_THREADS) as executor:
+                product_bboxes = list(executor.map(partial(self.get_product_lonlat_bbox, collection_id), products))
+            for product, product_bbox in zip(products, product_bboxes):
+                for entry_filename in self.get_product_entries(collection_id, product):
+                    if file_endings is not None and not entry_filename.endswith(tuple(file_endings)):
+                        continue
+                    _, shared_file = get_output_file_for_entry(shared_run_folder, entry_filename)
+                    for aoi_name, lonlat_bbox in aois.items():
+                        # products without a footprint go to all AOIs
+                        if product_bbox is not None and not bboxes_intersect(product_bbox, lonlat_bbox):
+                            continue
+                        out_folder, output_file = get_output_file_for_entry(os.path.join(output_folder, aoi_name),
+                                                                            entry_filename)
+                        os.makedirs(out_folder, exist_ok=True)
+                        n_links[aoi_name] += link_file(shared_file, output_file)
+
+        for aoi_name in aois:
+            logger.info(f"Linked {n_links[aoi_name]} files from {shared_run_folder} into the folder of AOI {aoi_name}.")
+
+    def get_tarball_path(self, output_folder, run_name, compression='gz'):
         if self.output_folder_run is None:
             self.output_folder_run = os.path.join(output_folder, run_name)
+        suffix = f".tar.{compression}" if compression is not None else ".tar"
+        return os.path.join(self.output_folder_run, f"tarball_{run_name}{suffix}")
+
+    def open_tarball(self, output_folder, run_name, compression='gz', n_threads=None):
+        # files are added to the tarball as soon as they are downloaded
+        self.output_folder_run = os.path.join(output_folder, run_name)
+        os.makedirs(self.output_folder_run, exist_ok=True)
+        tarball_path = self.get_tarball_path(output_folder, run_name, compression)
+        logger.info(f"Writing downloaded files to tarball at {tarball_path}.")
+        self.archiver = TarArchiver(tarball_path, self.output_folder_run, compression=compression,
+                                    n_threads=n_threads)
 
-        tarball_path = os.path.join(self.output_folder_run, f"tarball_{run_name}.tar.gz")
-        logger.info(f"Creating tarball at {tarball_path}.")
-        with tarfile.open(tarball_path, "w:gz") as tar:
-            tar.add(self.output_folder_run, arcname=os.path.basename(self.output_folder_run))
+    def create_tarball(self, output_folder, run_name, compression='gz', n_threads=None):
+        if self.archiver is None:
+            tarball_path = self.get_tarball_path(output_folder, run_name, compression)
+            logger.info(f"Creating tarball at {tarball_path}.")
+            self.archiver = TarArchiver(tarball_path, self.output_folder_run, compression=compression,
+                                        n_threads=n_threads)
+        # adds the files that were not downloaded in this run
+        self.archiver.add_folder(self.output_folder_run)
+        self.archiver.close()
+        tarball_path = self.archiver.tarball_path
+        self.archiver = None
         logger.info(f"Created tarball at {tarball_path}")
         return tarball_path
 
@@ -190,63 +653,365 @@ def get_coverage(coverage, filenames):
 
 
 def filter_chunks(chunks_list, entries):
-    filtered_entries = []
-    chunk_patterns = [f"*_????_00{str(chunk).zfill(2)}.nc" for chunk in chunks_list]
-    for entry in entries:
-        for chunk_pattern in chunk_patterns:
-            if fnmatch.fnmatch(entry, chunk_pattern):
-                filtered_entries.append(entry)
-    return filtered_entries
+    return [entry.name for entry in FciEntryIndex(entries).select(chunks_list)]
 
 
-def download_file(args):
-    product, file, output_file = args
+def split_time_range(start_time, end_time, window):
+    windows = []
+    while True:
+        window_end = min(start_time + window, end_time)
+        windows.append((start_time, window_end))
+        if window_end >= end_time:
+            return windows
+        start_time = window_end
+
+
+def get_union_bbox(lonlat_bboxes):
+    wests, souths, easts, norths = zip(*lonlat_bboxes)
+    return [min(wests), min(souths), max(easts), max(norths)]
+
+
+def bboxes_intersect(lonlat_bbox_a, lonlat_bbox_b):
+    west_a, south_a, east_a, north_a = lonlat_bbox_a
+    west_b, south_b, east_b, north_b = lonlat_bbox_b
+    return west_a <= east_b and west_b <= east_a and south_a <= north_b and south_b <= north_a
+
+
+def get_geometry_points(geometry):
+    # [lon, lat] points of a GeoJSON geometry of any type, a point is a list of numbers and the other types
+    # are nested lists of points. Geometry collections hold their parts in 'geometries'
+    if geometry.get('type') == 'GeometryCollection':
+        return [point for part in geometry.get('geometries', []) for point in get_geometry_points(part)]
+    points = []
+    parts = [geometry['coordinates']]
+    while len(parts) > 0:
+        part = parts.pop()
+        if not isinstance(part, list):
+            raise TypeError(f"Unexpected coordinates {part}")
+        if len(part) > 0 and all(isinstance(value, (int, float)) for value in part):
+            points.append(part[:2])
+        else:
+            parts.extend(part)
+    return points
+
+
+def get_product_bbox(product):
+    # lon/lat bbox of the GeoJSON footprint of a product, None if it has none or it cannot be parsed, so that
+    # the product is kept for all AOIs rather than dropped
+    geometry = product.metadata.get('geometry')
+    try:
+        lons, lats = zip(*get_geometry_points(geometry))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def link_file(source, destination):
+    # hard links share the data without copying it, symlinks are used where hard links are not possible,
+    # e.g. across file systems. Returns 1 if a link was created
+    if not os.path.exists(source) or os.path.lexists(destination):
+        return 0
+    try:
+        os.link(source, destination)
+    except OSError:
+        os.symlink(os.path.abspath(source), destination)
+    return 1
+
+
+def get_output_file_for_entry(output_folder_run, entry_filename):
+    # cannot check the product.format as it takes forever to get (?)
+    entry_folder, _, entry_name = entry_filename.rpartition('/')
+    if ".SEN" in entry_folder:
+        # the files of SAFE products go to a folder named after the product
+        out_folder = os.path.join(output_folder_run, entry_folder.replace('/', ''))
+        return out_folder, os.path.join(out_folder, entry_name)
+    return output_folder_run, os.path.join(output_folder_run, entry_filename)
+
+
+def get_expected_size(fsrc, offset):
+    # the total size is in Content-Range for ranged reads, otherwise Content-Length is all that is left to read
+    if fsrc.headers.get('Content-Encoding') not in (None, 'identity'):
+        return None
+    content_range = fsrc.headers.get('Content-Range')
+    if content_range is not None and '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.split('/')[-1])
+    content_length = fsrc.headers.get('Content-Length')
+    if content_length is not None:
+        return offset + int(content_length)
+    return None
+
+
+def get_task_priority(priority_policy, sensing_start, is_fci_chunk, collection_index, task_index):
+    # lowest priority is downloaded first, task_index counts the tasks submitted for the collection so far
+    timestamp = sensing_start.timestamp()
+    if priority_policy == "oldest_first":
+        return timestamp, collection_index
+    if priority_policy == "newest_first":
+        return -timestamp, collection_index
+    if priority_policy == "fci_chunks_first":
+        # the FCI L1c chunks (only those of the bbox if one is given) before the files of the other collections
+        return not is_fci_chunk, -timestamp, collection_index
+    # round_robin: take turns between the collections
+    return task_index, collection_index
+
+
+def get_n_parallel_downloads(n_parallel_downloads, collection_id):
+    # either a single number for all collections or a dict with the number per collection id
+    if isinstance(n_parallel_downloads, dict):
+        n_parallel_downloads = n_parallel_downloads.get(collection_id)
+    if n_parallel_downloads is None:
+        return DEFAULT_N_PARALLEL_DOWNLOADS
+    return max(1, n_parallel_downloads)
+
+
+def get_task_host(task):
+    # downloads are paused per host when it keeps failing
+    product, _, _ = task
+    return urlparse(product.datastore.urls.get("datastore", "download product",
+                                               vars={"collection_id": str(product.collection),
+                                                     "product_id": str(product)})).netloc
+
+
+@contextmanager
+def open_product_entry(product, entry, session=None, custom_headers=None):
+    if session is None:
+        with product.open(entry=entry, custom_headers=custom_headers) as fsrc:
+            yield fsrc
+        return
+
+    # same request as product.open, but going through the shared session to reuse its connections
+    url = product.datastore.urls.get("datastore", "download product",
+                                     vars={"collection_id": str(product.collection), "product_id": str(product)})
+    headers = {**eumdac.common.headers, **(custom_headers or {})}
+    with session.get(url + "/entry", auth=product.datastore.token.auth, params={"name": entry}, stream=True,
+                     headers=headers, timeout=DOWNLOAD_TIMEOUT_S) as response:
+        eumdac_raise_for_status(f"Could not download Product {product} of Collection {product.collection}",
+                                response, eumdac.product.ProductError)
+        response.raw.decode_content = True
+        yield response.raw
+
+
+def copy_stream(fsrc, fdst, progress_callback=None, checksum=None):
+    while True:
+        buffer = fsrc.read(DOWNLOAD_CHUNK_SIZE)
+        if not buffer:
+            break
+        fdst.write(buffer)
+        if checksum is not None:
+            checksum.update(buffer)
+        if progress_callback is not None:
+            progress_callback(len(buffer))
+
+
+def get_file_checksum(filename):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for buffer in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            checksum.update(buffer)
+    return checksum
+
+
+def fetch_entry(product, file, output_file, session=None, progress_callback=None):
+    # data is written to a partial file first and only renamed once complete, so that an interrupted
+    # transfer is never mistaken for a finished one and can be resumed on the next run
+    partial_file = output_file + PARTIAL_FILE_SUFFIX
+    offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+    custom_headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
     try:
-        with product.open(entry=file) as fsrc, \
-                open(os.path.join(output_file), mode='wb') as fdst:
-            shutil.copyfileobj(fsrc, fdst)
-            logger.info(f'Download of file {output_file} finished.')
+        with open_product_entry(product, file, session, custom_headers) as fsrc:
+            if offset > 0:
+                if fsrc.status == 206:
+                    logger.info(f'Resuming download of file {output_file} from byte {offset}.')
+                else:
+                    logger.info(f'Ranged reads not supported for {output_file}, restarting download.')
+                    offset = 0
+            checksum = get_file_checksum(partial_file) if offset > 0 else hashlib.md5()
+            expected_size = get_expected_size(fsrc, offset)
+            with open(partial_file, mode='ab' if offset > 0 else 'wb') as fdst:
+                copy_stream(fsrc, fdst, progress_callback, checksum)
     except eumdac.product.ProductError as error:
-        logger.info(f"Error related to the product '{product}' while trying to download it: '{error}'")
-    except requests.exceptions.ConnectionError as error:
-        logger.info(f"Error related to the connection: '{error}'")
+        if offset > 0 and (error.extra_info or {}).get('status') == 416:
+            # the partial file does not match the remote file anymore, start from scratch
+            logger.info(f'Cannot resume download of file {output_file}, restarting download.')
+            os.remove(partial_file)
+            return fetch_entry(product, file, output_file, session, progress_callback)
+        logger.warning(f"Error related to the product '{product}' while trying to download it: '{error}'")
+        if not is_transient_status((error.extra_info or {}).get('status')):
+            # e.g. no access to the product or the entry does not exist
+            raise PermanentDownloadError(str(error)) from error
+        return None, str(error)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError) as error:
+        logger.warning(f"Error related to the connection: '{error}'")
+        return None, str(error)
     except requests.exceptions.RequestException as error:
-        logger.info(f"Unexpected error: {error}")
+        logger.warning(f"Unexpected error: {error}")
+        status = error.response.status_code if error.response is not None else None
+        if not isinstance(error, requests.exceptions.HTTPError) or not is_transient_status(status):
+            raise PermanentDownloadError(str(error)) from error
+        return None, str(error)
+    except urllib3.exceptions.HTTPError as error:
+        # errors while streaming the raw response, e.g. a connection reset or a read timeout mid-transfer
+        logger.warning(f"Error related to the connection: '{error}'")
+        return None, str(error)
+
+    downloaded_size = os.path.getsize(partial_file)
+    if expected_size is not None and downloaded_size != expected_size:
+        logger.warning(f'Download of file {output_file} incomplete ({downloaded_size} of {expected_size} bytes), '
+                       f'resuming on the next attempt.')
+        if downloaded_size > expected_size:
+            os.remove(partial_file)
+        return None, f"incomplete download ({downloaded_size} of {expected_size} bytes)"
+
+    os.replace(partial_file, output_file)
+    logger.info(f'Download of file {output_file} finished.')
+    return checksum.hexdigest(), None
+
+
+def download_file(args, session=None, progress_callback=None, journal=None):
+    # returns False for failures worth retrying, raises PermanentDownloadError for the others once recorded
+    product, file, output_file = args
+    start_time = time.monotonic()
+    permanent_error = None
+    try:
+        checksum, error = fetch_entry(product, file, output_file, session, progress_callback)
+    except PermanentDownloadError as exception:
+        permanent_error = exception
+        checksum, error = None, str(exception)
+    success = error is None
+    if journal is not None:
+        journal.record(str(product.collection), str(product), file, output_file,
+                       STATUS_DONE if success else STATUS_FAILED,
+                       size=os.path.getsize(output_file) if success else None, checksum=checksum,
+                       duration_s=time.monotonic() - start_time, error=error)
+    if permanent_error is not None:
+        raise permanent_error
+    return success
 
 
 def download_from_eumdac(start_time, end_time, collection_ids, output_folder, eumdac_key, eumdac_secret, run_name="",
                          file_endings=None, fci_l1c_chunks_lonlat_bbox=None, search_bbox=None, create_tarball=False,
-                         n_parallel_downloads=4):
+                         n_parallel_downloads=4, search_cache_folder=SEARCH_CACHE_FOLDER, refresh_search_cache=False,
+                         follow=False, poll_interval_s=DEFAULT_POLL_INTERVAL_S, priority_policy=None, max_mb_per_s=None,
+                         tarball_compression='gz', max_retries=DEFAULT_MAX_RETRIES):
     """Downloads EUMETSAT data products from the EUMDAC archive.
 
     Some of the custom features:
     - can filter FCI L1c chunks based on a lon/lat bounding box
     - can filter LEO products based on a lon/lat bounding box
     - adapts the search start/end times so that L2 products are retrieved correctly (avoids start/end overlap issue)
-    - downloads using multiple processes
+    - downloads all collections at the same time using a pool of threads sharing one authenticated session,
+      with a configurable priority policy, per-collection concurrency and global bandwidth limit
+    - splits long time ranges into windows that are searched in parallel, downloading the products of each
+      window as soon as it has been searched
+    - caches search results on disk, so that repeated runs over the same window skip the catalogue search
+    - keeps a journal of the downloads in the run folder, so that re-runs only download missing or failed files
+    - writes downloads to .part files first and resumes interrupted downloads on the next run
+    - retries failed downloads within the run with exponential backoff, pausing a host that keeps failing
+    - can follow the collections in near-real time, downloading new products as soon as they are found
 
     Args:
         start_time (str): Start time in ISO format 'YYYY-MM-DDThh:mm:ss'
-        end_time (str): End time in ISO format 'YYYY-MM-DDThh:mm:ss'
+        end_time (str): End time in ISO format 'YYYY-MM-DDThh:mm:ss'. In follow mode, None follows the collections
+            indefinitely.
         collection_ids (list): List of EUMETSAT collection IDs to download
         output_folder (str): Local directory path to store downloaded files
         eumdac_key (str): EUMDAC API access key
         eumdac_secret (str): EUMDAC API secret key
         run_name (str, optional): Subdirectory name for downloads. Defaults to "".
         file_endings (list, optional): List of file extensions to filter downloads
-        fci_l1c_chunks_lonlat_bbox (list, optional): Lon/lat bounding box for FCI L1C data chunks. Defaults to None.
+        fci_l1c_chunks_lonlat_bbox (list, optional): Lon/lat bounding box for FCI L1C data chunks, or a list of
+            bounding boxes to download the chunks of all of them. Defaults to None.
         search_bbox (list, optional): Lon/lat bounding box to filter product search. Defaults to None.
-        create_tarball (bool, optional): Create compressed tarball of downloads. Defaults to False.
-        n_parallel_downloads (int, optional): Number of parallel download processes. Defaults to 4.
+        create_tarball (bool, optional): Create a tarball of the downloads, files are added to it as soon as they
+            are downloaded. Defaults to False.
+        n_parallel_downloads (int or dict, optional): Maximum number of parallel downloads per collection, either
+            for all collections or as a dict per collection ID. Defaults to 4.
+        search_cache_folder (str, optional): Folder of the search result cache, None disables the cache.
+            Defaults to SEARCH_CACHE_FOLDER.
+        refresh_search_cache (bool, optional): Ignore cached search results and search again. Defaults to False.
+        follow (bool, optional): After the download of the time range, keep polling the collections for products
+            newer than the last downloaded sensing time (kept per collection in the run journal) until end_time.
+            Defaults to False.
+        poll_interval_s (int, optional): Time between two polls in follow mode. Defaults to 60.
+        priority_policy (str, optional): Order of the downloads across all collections, one of "oldest_first",
+            "newest_first", "fci_chunks_first" (the FCI L1c chunks before the files of the other collections,
+            newest first) or "round_robin" (alternating between collections). Defaults to "newest_first" in follow
+            mode and "oldest_first" otherwise.
+        max_mb_per_s (float, optional): Global bandwidth limit in MB/s for all downloads. Defaults to None.
+        tarball_compression (str, optional): Compression of the tarball, 'gz' or 'zst' (compressed on all cores
+            if pigz/zstd are installed) or None for a plain tar, which is updated incrementally on re-runs. As
+            the downloaded NetCDF files are compressed already, None is the fastest. Defaults to 'gz'.
+        max_retries (int, optional): Number of times a failed download is retried within the run, with
+            exponential backoff. Files that could not be recovered are listed at the end. Defaults to 5.
     """
 
-    eumdac_downloader = EumdacDownloader(eumdac_key, eumdac_secret)
-    eumdac_downloader.search_products_for_collections(collection_ids, start_time, end_time, search_bbox=search_bbox)
-    eumdac_downloader.download_products_for_collections(collection_ids, output_folder, run_name, file_endings,
-                                                        fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox,
-                                                        n_parallel_downloads=n_parallel_downloads)
+    search_cache = SearchCache(search_cache_folder) if search_cache_folder is not None else None
+    eumdac_downloader = EumdacDownloader(eumdac_key, eumdac_secret, search_cache=search_cache)
     if create_tarball:
-        eumdac_downloader.create_tarball(output_folder, run_name)
+        eumdac_downloader.open_tarball(output_folder, run_name, compression=tarball_compression)
+    if follow:
+        eumdac_downloader.follow_collections(collection_ids, start_time, end_time, output_folder, run_name,
+                                             file_endings, fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox,
+                                             search_bbox=search_bbox, n_parallel_downloads=n_parallel_downloads,
+                                             poll_interval_s=poll_interval_s,
+                                             priority_policy=priority_policy or "newest_first",
+                                             max_mb_per_s=max_mb_per_s, max_retries=max_retries)
+    else:
+        eumdac_downloader.search_and_download_products_for_collections(
+            collection_ids, start_time, end_time, output_folder, run_name, file_endings,
+            fci_l1c_chunks_lonlat_bbox=fci_l1c_chunks_lonlat_bbox, search_bbox=search_bbox,
+            refresh_search_cache=refresh_search_cache, n_parallel_downloads=n_parallel_downloads,
+            priority_policy=priority_policy or DEFAULT_PRIORITY_POLICY, max_mb_per_s=max_mb_per_s,
+            max_retries=max_retries)
+    eumdac_downloader.close()
+    if create_tarball:
+        eumdac_downloader.create_tarball(output_folder, run_name, compression=tarball_compression)
+    return
+
+
+def download_aois_from_eumdac(start_time, end_time, collection_ids, output_folder, eumdac_key, eumdac_secret, aois,
+                              file_endings=None, shared_run_name=DEFAULT_SHARED_RUN_NAME, n_parallel_downloads=4,
+                              search_cache_folder=SEARCH_CACHE_FOLDER, refresh_search_cache=False,
+                              priority_policy=DEFAULT_PRIORITY_POLICY, max_mb_per_s=None,
+                              max_retries=DEFAULT_MAX_RETRIES):
+    """Downloads EUMETSAT data products for several areas of interest at once.
+
+    The collections are searched once over the union of the AOIs and every file needed by at least one AOI is
+    downloaded once into a shared store. The files each AOI needs are then linked into its own run folder,
+    with hard links where possible and symlinks otherwise.
+
+    Args:
+        start_time (str): Start time in ISO format 'YYYY-MM-DDThh:mm:ss'
+        end_time (str): End time in ISO format 'YYYY-MM-DDThh:mm:ss'
+        collection_ids (list): List of EUMETSAT collection IDs to download
+        output_folder (str): Local directory path to store downloaded files
+        eumdac_key (str): EUMDAC API access key
+        eumdac_secret (str): EUMDAC API secret key
+        aois (dict): Lon/lat bounding box [west, south, east, north] per AOI name, the name is used as the
+            run folder of the AOI. FCI L1c files are selected per AOI by chunk, other products by their footprint.
+        file_endings (list, optional): List of file extensions to filter downloads
+        shared_run_name (str, optional): Subdirectory of the shared store. Defaults to "shared".
+        n_parallel_downloads (int or dict, optional): Maximum number of parallel downloads per collection.
+            Defaults to 4.
+        search_cache_folder (str, optional): Folder of the search result cache, None disables the cache.
+            Defaults to SEARCH_CACHE_FOLDER.
+        refresh_search_cache (bool, optional): Ignore cached search results and search again. Defaults to False.
+        priority_policy (str, optional): Order of the downloads across all collections. Defaults to "oldest_first".
+        max_mb_per_s (float, optional): Global bandwidth limit in MB/s for all downloads. Defaults to None.
+        max_retries (int, optional): Number of times a failed download is retried within the run. Defaults to 5.
+    """
+
+    search_cache = SearchCache(search_cache_folder) if search_cache_folder is not None else None
+    eumdac_downloader = EumdacDownloader(eumdac_key, eumdac_secret, search_cache=search_cache)
+    aoi_bboxes = list(aois.values())
+    eumdac_downloader.search_and_download_products_for_collections(
+        collection_ids, start_time, end_time, output_folder, shared_run_name, file_endings,
+        fci_l1c_chunks_lonlat_bbox=aoi_bboxes, search_bbox=get_union_bbox(aoi_bboxes),
+        refresh_search_cache=refresh_search_cache, n_parallel_downloads=n_parallel_downloads,
+        priority_policy=priority_policy, max_mb_per_s=max_mb_per_s, max_retries=max_retries, aoi_bboxes=aoi_bboxes)
+    eumdac_downloader.close()
+    eumdac_downloader.link_downloads_to_aois(collection_ids, aois, output_folder, shared_run_name, file_endings)
     return
 
 
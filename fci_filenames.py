@@ -0,0 +1,96 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+# e.g. W_XX-EUMETSAT-Darmstadt,IMG+SAT,MTI1+FCI-1C-RRAD-FDHSI-FD--CHK-BODY--DIS-NC4E_C_EUMT_20240915155406_IDPFI_OPE_
+#      20240915155007_20240915155029_N_JLS_C_0095_0001.nc
+FCI_FILENAME_PATTERN = re.compile(
+    r"(?:^|/)[^/]*\+FCI-(?P<level>\w+)-(?P<product>\w+)-(?P<product_type>\w+)-[^/]*?-(?P<chunk_type>BODY|TRAIL)-"
+    r"[^/]*_(?P<start_time>\d{14})_(?P<end_time>\d{14})_[^_/]*_[^_/]*_[^_/]*"
+    r"_(?P<repeat_cycle>\d{4})_(?P<chunk>\d{4})\.nc$")
+
+FciEntry = namedtuple("FciEntry", ["name", "product_type", "is_trail", "repeat_cycle", "chunk", "start_time",
+                                   "end_time", "product"])
+
+
+def parse_fci_filename(filename, product=None):
+    # returns None for names that are not FCI chunk files
+    match = FCI_FILENAME_PATTERN.search(filename)
+    if match is None:
+        return None
+    return FciEntry(name=filename,
+                    product_type=match.group("product_type"),
+                    is_trail=match.group("chunk_type") == "TRAIL",
+                    repeat_cycle=int(match.group("repeat_cycle")),
+                    chunk=int(match.group("chunk")),
+                    start_time=datetime.strptime(match.group("start_time"), "%Y%m%d%H%M%S"),
+                    end_time=datetime.strptime(match.group("end_time"), "%Y%m%d%H%M%S"),
+                    product=product)
+
+
+class FciEntryIndex:
+    """In-memory index of FCI chunk files, so that chunk selection is a lookup instead of pattern matching."""
+
+    def __init__(self, filenames=(), product=None):
+        self.entries_by_chunk = defaultdict(list)
+        self.trail_entries = []
+        self.unparsed = []
+        self.add(filenames, product=product)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries_by_chunk.values())
+
+    def add(self, filenames, product=None):
+        for filename in filenames:
+            entry = parse_fci_filename(filename, product=product)
+            if entry is None:
+                self.unparsed.append(filename)
+                continue
+            self.entries_by_chunk[entry.chunk].append(entry)
+            if entry.is_trail:
+                self.trail_entries.append(entry)
+
+    def select(self, chunks=None, include_trail=False, start_time=None, end_time=None):
+        # chunks None selects all chunks, start_time/end_time select on the sensing start of the files
+        if chunks is None:
+            chunks = list(self.entries_by_chunk)
+        chunks = set(chunks)
+        selected = [entry for chunk in chunks for entry in self.entries_by_chunk.get(chunk, [])]
+        if include_trail:
+            selected += [entry for entry in self.trail_entries if entry.chunk not in chunks]
+        if start_time is not None:
+            selected = [entry for entry in selected if entry.start_time >= start_time]
+        if end_time is not None:
+            selected = [entry for entry in selected if entry.start_time < end_time]
+        return sorted(selected, key=lambda entry: (entry.start_time, entry.chunk))
+
+
+class FciTimeIndex:
+    """FCI chunk files sorted by start time, to look up the files of a time window by bisection."""
+
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: (entry.start_time, entry.chunk))
+        self.start_times = [entry.start_time for entry in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def select(self, start_time, end_time):
+        # entries with their sensing start in [start_time, end_time)
+        first = bisect_left(self.start_times, start_time)
+        last = bisect_left(self.start_times, end_time)
+        return self.entries[first:last]
@@ -11,112 +11,566 @@
 # You should have received a copy of the GNU General Public License along with this program.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from multiprocessing import get_context
 
+import dask
 import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyresample.geometry import AreaDefinition
 from satpy import Scene
-from satpy.readers import find_files_and_readers, FSFile
+from satpy.readers import FSFile
+from satpy.writers import compute_writer_results, get_enhanced_image
 
 import credentials
+from bucket_cache import BucketCache, CACHE_FOLDER, CACHE_SIZE_LIMIT_GB, combine_stats, print_cache_stats
+from fci_filenames import FciEntryIndex, FciTimeIndex
+from get_fci_chunks_for_area import get_chunks_for_lon_lat_bbox, get_chunks_for_lon_lat_points, get_rows_for_lon_lat
 
 import warnings
 
 warnings.filterwarnings("ignore", category=RuntimeWarning, module="dask")
 warnings.filterwarnings("ignore", category=RuntimeWarning, module="satpy")
 
-CACHE_SIZE_LIMIT_GB = 4
-CACHE_FOLDER = "./bucket_cache/"
+# simplecache copies every remote file whole to the local cache, blockcache only fetches the byte ranges that are
+# read (the requested channels of each file) and caches these blocks on disk until the RC is processed
+REMOTE_READ_MODES = ["simplecache", "blockcache"]
+BLOCK_CACHE_FOLDER = "./bucket_block_cache/"
+REMOTE_BLOCK_SIZE = 2 * 1024 ** 2
+CROP_PLAN_FOLDER = "./crop_plans/"
+# every dataset is written to a subfolder named after it
+OUTPUT_FILENAME = os.path.join("{name}", "{start_time:%Y-%m-%dT%H%M}_mtg_fci_{name}.tif")
+# options of the GeoTIFF writer, e.g. tiling, compression and GDAL threads. COG_WRITER_KWARGS writes Cloud
+# Optimized GeoTIFFs
+DEFAULT_WRITER_KWARGS = {}
+COG_WRITER_KWARGS = {"driver": "COG", "compress": "DEFLATE", "num_threads": "ALL_CPUS"}
+# "geotiff" writes a file per dataset and RC, "zarr" appends the RCs of each dataset along the time dimension
+# of a compressed Zarr cube
+OUTPUT_FORMATS = ["geotiff", "zarr"]
+# RCs per chunk along the time dimension of the cubes, one day of 10-minute RCs
+CUBE_TIME_CHUNK = 144
+POINTS_FILENAME = "fci_points.csv"
+# margin around the points of the area that is loaded to sample them, in degrees
+POINTS_BBOX_MARGIN = 0.1
 
+# crop plans already computed or loaded by this process, by geometry key
+crop_plans = {}
+# (rows, columns) of the sampled points in the areas they were sampled from, by geometry key
+point_indices = {}
 
-def run_satpy_for_files_and_area(fci_filenames, datasets, lonlat_bbox, output_dir):
+
+def get_geometry_key(lonlats, area):
+    key = json.dumps([[float(value) for value in lonlats], area.crs.to_wkt(), list(area.shape),
+                      list(area.area_extent)])
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get_crop_plan(lonlat_bbox, area, plan_folder=CROP_PLAN_FOLDER):
+    # rows and columns of the area covering the bbox as [y_start, y_stop, x_start, x_stop]. The FCI grid is the
+    # same for every RC, so the plan is computed once and kept in memory and in the plan folder for later runs
+    key = get_geometry_key(lonlat_bbox, area)
+    if key in crop_plans:
+        return crop_plans[key]
+
+    plan_file = os.path.join(plan_folder, f"{key}.json")
+    if os.path.exists(plan_file):
+        with open(plan_file) as f:
+            plan = json.load(f)
+    else:
+        # same computation as Scene.crop(ll_bbox=...)
+        ll_area = AreaDefinition("crop_area", "crop_area", "crop_latlong", {"proj": "latlong"}, 100, 100,
+                                 lonlat_bbox)
+        x_slice, y_slice = area.get_area_slices(ll_area)
+        plan = [int(y_slice.start), int(y_slice.stop), int(x_slice.start), int(x_slice.stop)]
+        os.makedirs(plan_folder, exist_ok=True)
+        # written under a name of its own first, the plan folder is shared by the worker processes
+        tmp_file = f"{plan_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(plan, f)
+        os.replace(tmp_file, plan_file)
+    crop_plans[key] = plan
+    return plan
+
+
+def crop_to_lonlat_bbox(scn, lonlat_bbox):
+    # equivalent to scn.crop(ll_bbox=lonlat_bbox), but projecting the bbox on the grid only once per run
+    area = scn.coarsest_area()
+    y_start, y_stop, x_start, x_stop = get_crop_plan(lonlat_bbox, area)
+    # the outer pixel centres of the window map back to the same slices in the projection of the area
+    xs, ys = area.get_proj_vectors()
+    x_bounds = xs[x_start], xs[x_stop - 1]
+    y_bounds = ys[y_start], ys[y_stop - 1]
+    return scn.crop(xy_bbox=(min(x_bounds), min(y_bounds), max(x_bounds), max(y_bounds)))
+
+
+def get_cube_path(output_dir, dataset):
+    return os.path.join(output_dir, f"{dataset}.zarr")
+
+
+def get_cube_times(cube_path):
+    # sensing start times of the RCs in a cube, empty if it does not exist yet
+    if not os.path.exists(cube_path):
+        return []
+    with xr.open_zarr(cube_path) as cube:
+        return cube["time"].values.astype("datetime64[us]").tolist()
+
+
+def is_rc_in_cubes(rc_start, rc_end, cube_times):
+    # cube_times holds the times of the cube of each dataset
+    return all(any(rc_start <= time < rc_end for time in times) for times in cube_times)
+
+
+def to_cube_array(data_arr, enhance):
+    # composites are stored as the 8 bit image written to GeoTIFF, channels as their calibrated values
+    start_time = data_arr.attrs['start_time']
+    crs_wkt = data_arr.attrs['area'].crs.to_wkt()
+    if enhance:
+        data_arr, _ = get_enhanced_image(data_arr).finalize(fill_value=0, dtype=np.uint8)
+    # satpy's attributes and non-dimension coordinates (area, crs, ...) cannot be stored in zarr. The copy keeps
+    # the attributes of the Scene's DataArray, which shares its variable
+    data_arr = data_arr.copy(deep=False)
+    data_arr = data_arr.drop_vars([coord for coord in data_arr.coords if coord not in data_arr.dims])
+    data_arr.attrs = {'crs_wkt': crs_wkt}
+    if 'bands' in data_arr.coords:
+        # variable length strings, zarr has no stable format for fixed length ones
+        data_arr = data_arr.assign_coords(bands=data_arr['bands'].astype(object))
+    return data_arr.expand_dims(time=[np.datetime64(start_time, "us")])
+
+
+def get_cube_encoding(name, data_arr):
+    # fixed time units, xarray would otherwise pick units from the first RC that do not fit the next ones
+    return {name: {"chunks": (CUBE_TIME_CHUNK,) + data_arr.shape[1:]},
+            "time": {"units": "seconds since 2000-01-01", "dtype": "int64"}}
+
+
+def insert_into_cube(cube_path, name, dataset):
+    # the cube is rewritten in time order next to the old one, which is only replaced once the new one is complete
+    new_path = cube_path + ".new"
+    old_path = cube_path + ".old"
+    with xr.open_zarr(cube_path) as cube:
+        cube = xr.concat([cube, dataset], dim="time").sortby("time")
+        cube = cube.chunk({dim: CUBE_TIME_CHUNK if dim == "time" else -1 for dim in cube[name].dims})
+        for variable in cube.variables.values():
+            variable.encoding = {}
+        cube.to_zarr(new_path, mode="w", encoding=get_cube_encoding(name, cube[name]))
+    os.rename(cube_path, old_path)
+    os.rename(new_path, cube_path)
+    shutil.rmtree(old_path)
+
+
+def append_to_cube(cube_path, name, data_arr, cube_times=None):
+    # cube_times are the times already in the cube. An RC older than the last one, e.g. a failed RC processed again,
+    # is inserted in time order, so that the time axis stays sorted
+    dataset = data_arr.to_dataset(name=name)
+    if not os.path.exists(cube_path):
+        dataset.to_zarr(cube_path, mode="w-", encoding=get_cube_encoding(name, data_arr))
+    elif cube_times and data_arr["time"].values[0].astype("datetime64[us]").tolist() < max(cube_times):
+        print(f"Inserting {data_arr['time'].values[0]} before the last time of {cube_path}, rewriting it.")
+        insert_into_cube(cube_path, name, dataset)
+    else:
+        dataset.to_zarr(cube_path, mode="a", append_dim="time")
+
+
+def get_cube_arrays(scn_crop, single_channel_ds, scn_crop_r, multi_channel_ds, output_dir):
+    # (cube path, dataset, data) of the datasets of an RC, not computed yet
+    return ([(get_cube_path(output_dir, ds), ds, to_cube_array(scn_crop[ds], enhance=False))
+             for ds in single_channel_ds] +
+            [(get_cube_path(output_dir, ds), ds, to_cube_array(scn_crop_r[ds], enhance=True))
+             for ds in multi_channel_ds])
+
+
+def append_to_cubes(cube_arrays):
+    # one compute for all datasets, as for the GeoTIFFs
+    arrays = dask.compute(*[data_arr for _, _, data_arr in cube_arrays])
+    for (cube_path, dataset, _), data_arr in zip(cube_arrays, arrays):
+        os.makedirs(os.path.dirname(cube_path), exist_ok=True)
+        # an RC is already in some cubes if a previous run stopped while appending it
+        cube_times = get_cube_times(cube_path)
+        if data_arr["time"].values[0].astype("datetime64[us]").tolist() not in cube_times:
+            append_to_cube(cube_path, dataset, data_arr, cube_times)
+
+
+def run_satpy_for_files_and_areas(fci_filenames, datasets, aoi_outputs, writer_kwargs=None, output_format="geotiff"):
+    # Loads the Scene once and writes its crop to each (lonlat_bbox, output_dir) of aoi_outputs. The outputs of all
+    # AOIs are computed in a single pass, so that the chunks they share are only read and calibrated once
     scn = Scene(filenames=fci_filenames)
     scn.load(datasets, upper_right_corner='NE')
 
-    scn_crop = scn.crop(ll_bbox=lonlat_bbox)
+    if writer_kwargs is None:
+        writer_kwargs = DEFAULT_WRITER_KWARGS
+    # the datasets are only written once all of them are set up, so that dask computes them in a single pass
+    # and inputs shared by several datasets are read and calibrated once
+    writer_results = []
+    cube_arrays = []
+    for lonlat_bbox, output_dir in aoi_outputs:
+        scn_crop = crop_to_lonlat_bbox(scn, lonlat_bbox)
 
-    single_channel_ds = [ds for ds in datasets if ds in scn_crop and len(scn_crop[ds].shape) == 2]
-    for dataset in single_channel_ds:
-        out_dir_ds = os.path.join(output_dir, dataset)
-        scn_crop.save_dataset(dataset, filename="{start_time:%Y-%m-%dT%H%M}_mtg_fci_{name}.tif",
-                              base_dir=out_dir_ds,
-                              writer='geotiff', enhance=False)
+        single_channel_ds = [ds for ds in datasets if ds in scn_crop and len(scn_crop[ds].shape) == 2]
+        scn_crop_r = scn_crop.resample(scn_crop.finest_area(), resampler='native', reduce_data=False)
+        multi_channel_ds = [ds for ds in datasets if ds not in single_channel_ds]
+        if output_format == "zarr":
+            cube_arrays += get_cube_arrays(scn_crop, single_channel_ds, scn_crop_r, multi_channel_ds, output_dir)
+            continue
 
-    scn_crop_r = scn_crop.resample(scn_crop.finest_area(), resampler='native', reduce_data=False)
-    multi_channel_ds = [ds for ds in datasets if ds not in single_channel_ds]
-    for dataset in multi_channel_ds:
-        out_dir_ds = os.path.join(output_dir, dataset)
-        scn_crop_r.save_dataset(dataset, filename="{start_time:%Y-%m-%dT%H%M}_mtg_fci_{name}.tif",
-                                base_dir=out_dir_ds, writer='geotiff', enhance=True)
+        if len(single_channel_ds) > 0:
+            writer_results.append(scn_crop.save_datasets(datasets=single_channel_ds, filename=OUTPUT_FILENAME,
+                                                         base_dir=output_dir, writer='geotiff', enhance=False,
+                                                         compute=False, **writer_kwargs))
+
+        if len(multi_channel_ds) > 0:
+            writer_results.append(scn_crop_r.save_datasets(datasets=multi_channel_ds, filename=OUTPUT_FILENAME,
+                                                           base_dir=output_dir, writer='geotiff', enhance=True,
+                                                           compute=False, **writer_kwargs))
 
+    if output_format == "zarr":
+        append_to_cubes(cube_arrays)
+    else:
+        compute_writer_results(writer_results)
     return
 
 
-def clear_cache_if_exceeds_limit(cache_storage, size_limit_gb):
-    size_limit_bytes = size_limit_gb * 1024 ** 3  # Convert GB to bytes
-    cache_size = sum(
-        os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(cache_storage) for file in
-        files)
-    if cache_size > size_limit_bytes:
-        print("Clearing cache")
-        for root, dirs, files in os.walk(cache_storage):
-            for file in files:
-                os.remove(os.path.join(root, file))
-            for dir in dirs:
-                os.rmdir(os.path.join(root, dir))
+def run_satpy_for_files_and_area(fci_filenames, datasets, lonlat_bbox, output_dir, writer_kwargs=None,
+                                 output_format="geotiff"):
+    run_satpy_for_files_and_areas(fci_filenames, datasets, [(lonlat_bbox, output_dir)], writer_kwargs,
+                                  output_format)
+
+
+def get_points_bbox(points):
+    # bbox of the points seen by FCI, the others would stretch it over the edge of the disk
+    lons = points['longitude'].values
+    lats = points['latitude'].values
+    visible = ~np.isnan(get_rows_for_lon_lat(lons, lats))
+    return [lons[visible].min() - POINTS_BBOX_MARGIN, lats[visible].min() - POINTS_BBOX_MARGIN,
+            lons[visible].max() + POINTS_BBOX_MARGIN, lats[visible].max() + POINTS_BBOX_MARGIN]
+
+
+def get_point_indices(points, area):
+    # computed once per area, the RCs all share the same grid. Points outside of the area get index -1
+    key = get_geometry_key(list(points['longitude']) + list(points['latitude']), area)
+    if key not in point_indices:
+        cols, rows = area.get_array_indices_from_lonlat(points['longitude'].values, points['latitude'].values)
+        point_indices[key] = np.ma.filled(rows, -1), np.ma.filled(cols, -1)
+    return point_indices[key]
+
+
+def run_satpy_for_files_and_points(fci_filenames, datasets, points):
+    # Samples the datasets at the points, a DataFrame with longitude and latitude columns, and returns a table with
+    # one row per point. Only the dask chunks holding the points are computed, no image is written
+    scn = Scene(filenames=fci_filenames)
+    scn.load(datasets, upper_right_corner='NE')
+    scn_crop = crop_to_lonlat_bbox(scn, get_points_bbox(points))
+    # all datasets on the finest grid, the composites are only generated there
+    scn_crop_r = scn_crop.resample(scn_crop.finest_area(), resampler='native', reduce_data=False)
+
+    columns = {}
+    samples = []
+    for dataset in datasets:
+        if dataset not in scn_crop_r:
+            print(f"Dataset {dataset} could not be loaded, skipping it.")
+            continue
+        data_arr = scn_crop_r[dataset]
+        rows, cols = get_point_indices(points, data_arr.attrs['area'])
+        inside = (rows >= 0) & (cols >= 0)
+        if data_arr.ndim == 2:
+            names = [dataset]
+            samples.append(data_arr.data.vindex[rows.clip(0), cols.clip(0)][:, None])
+        else:
+            names = [f"{dataset}_{band}" for band in data_arr['bands'].values]
+            samples.append(data_arr.data.vindex[:, rows.clip(0), cols.clip(0)])
+        columns[dataset] = (names, inside)
+    start_time = scn_crop_r[list(columns)[0]].attrs['start_time'] if len(columns) > 0 else None
+    samples = dask.compute(*samples)
+
+    table = pd.DataFrame({'time': start_time, 'point_id': points.index, 'longitude': points['longitude'].values,
+                          'latitude': points['latitude'].values})
+    for (names, inside), values in zip(columns.values(), samples):
+        for name, column in zip(names, np.asarray(values, dtype=float).T):
+            table[name] = np.where(inside, column, np.nan)
+    return table
+
+
+def list_input_files(input_dir, fs=None):
+    # lists the input folder, or the bucket prefix when a filesystem is given, once for the whole run
+    if fs is None:
+        return [os.path.join(input_dir, name) for name in os.listdir(input_dir)]
+    return fs.ls(f"{credentials.S3_NERO_BUCKET_NAME}/{input_dir}", detail=False)
+
+
+def get_time_index(filenames, chunks):
+    # index of the files of the chunks and of the TRAIL files, other files in the folder are ignored
+    entry_index = FciEntryIndex(filenames)
+    return FciTimeIndex(entry_index.select(chunks, include_trail=True))
+
+
+def get_s3_options(**kwargs):
+    return {
+        "endpoint_url": credentials.S3_ENDPOINT,
+        "key": credentials.S3_NERO_ACCESS_KEY,
+        "secret": credentials.S3_NERO_SECRET_KEY,
+        **kwargs,
+    }
+
+
+def create_filesystem(remote_read_mode, bucket_cache=None, block_cache_folder=BLOCK_CACHE_FOLDER):
+    if remote_read_mode == "blockcache":
+        return fsspec.filesystem(
+            "blockcache",
+            target_protocol="s3",
+            target_options=get_s3_options(default_block_size=REMOTE_BLOCK_SIZE),
+            cache_storage=block_cache_folder
+        )
+    if bucket_cache is None:
+        # uncached, e.g. to list the bucket in the parent process of the workers
+        return fsspec.filesystem("s3", **get_s3_options())
+    return bucket_cache.get_filesystem(target_protocol="s3", target_options=get_s3_options())
+
+
+def run_satpy_for_rc(fci_filenames, datasets, aoi_outputs, writer_kwargs, output_format, points):
+    if points is not None:
+        return run_satpy_for_files_and_points(fci_filenames, datasets, points)
+    run_satpy_for_files_and_areas(fci_filenames, datasets, aoi_outputs, writer_kwargs, output_format)
+
+
+def clear_rc_blocks(fs, filenames):
+    # the blocks of the files of an RC are not read again by later RCs, removing them bounds the block cache
+    for filename in filenames:
+        fs.pop_from_cache(filename)
+    fs.save_cache()
+
+
+def process_rc(filenames, datasets, aoi_outputs, fs=None, bucket_cache=None, writer_kwargs=None,
+               output_format="geotiff", points=None, clear_blocks=False):
+    # returns the table of the sampled points if points are given. clear_blocks removes the blocks of the files
+    # from the block cache of fs once the RC is processed
+    if clear_blocks:
+        try:
+            return process_rc(filenames, datasets, aoi_outputs, fs=fs, bucket_cache=bucket_cache,
+                              writer_kwargs=writer_kwargs, output_format=output_format, points=points)
+        finally:
+            clear_rc_blocks(fs, filenames)
+
+    if fs is not None:
+        # manually create FSFiles for each found path and pass that to the Scene
+        filenames = [FSFile(fn, fs=fs) for fn in filenames]
+    fci_filenames = {'fci_l1c_nc': filenames}
+
+    if bucket_cache is not None:
+        # the files of the RC stay in the cache until it is processed
+        with bucket_cache.pin_accessed_files():
+            return run_satpy_for_rc(fci_filenames, datasets, aoi_outputs, writer_kwargs, output_format, points)
+    return run_satpy_for_rc(fci_filenames, datasets, aoi_outputs, writer_kwargs, output_format, points)
+
+
+# filesystem and bucket cache of a worker process, created once per process by init_rc_worker
+worker_state = {}
+
+
+def get_worker_cache_folder(cache_folder, worker_index):
+    return os.path.join(cache_folder, f"worker_{worker_index}")
+
+
+def remove_stale_worker_caches(cache_folder, n_workers):
+    # the cache folders of workers of earlier runs with more workers, which no worker of this run limits or evicts
+    if not os.path.isdir(cache_folder):
+        return
+    for name in os.listdir(cache_folder):
+        worker_index = name[len("worker_"):]
+        if name.startswith("worker_") and worker_index.isdigit() and int(worker_index) >= n_workers:
+            print(f"Removing the cache of worker {worker_index} of an earlier run.")
+            shutil.rmtree(os.path.join(cache_folder, name))
+
+
+def init_rc_worker(remote_files, remote_read_mode, n_dask_threads, worker_indices, n_workers):
+    if n_dask_threads is not None:
+        dask.config.set(scheduler='threads', num_workers=n_dask_threads)
+    # each worker takes one of the n_workers indices of the queue
+    worker_state['worker_index'] = worker_indices.get()
+    if remote_files:
+        # the workers cache in their own subfolder with an equal share of the size limit, so that no worker evicts
+        # the files another one is reading and the cache stays within the limit
+        bucket_cache = None
+        if remote_read_mode == "simplecache":
+            bucket_cache = BucketCache(get_worker_cache_folder(CACHE_FOLDER, worker_state['worker_index']),
+                                       CACHE_SIZE_LIMIT_GB / n_workers)
+        worker_state['bucket_cache'] = bucket_cache
+        worker_state['fs'] = create_filesystem(
+            remote_read_mode, bucket_cache,
+            block_cache_folder=get_worker_cache_folder(BLOCK_CACHE_FOLDER, worker_state['worker_index']))
+        worker_state['clear_blocks'] = remote_read_mode == "blockcache"
+
+
+def process_rc_in_worker(filenames, datasets, aoi_outputs, writer_kwargs=None, points=None):
+    # returns the worker index and its cache stats so far with the result, for the stats of the whole run
+    bucket_cache = worker_state.get('bucket_cache')
+    table = process_rc(filenames, datasets, aoi_outputs, fs=worker_state.get('fs'), bucket_cache=bucket_cache,
+                       writer_kwargs=writer_kwargs, points=points, clear_blocks=worker_state.get('clear_blocks', False))
+    cache_stats = bucket_cache.get_stats() if bucket_cache is not None else None
+    return table, worker_state['worker_index'], cache_stats
+
+
+def append_points_table(table, points_file):
+    # the tables of the RCs are streamed to one CSV file, with the header written by the first RC. The columns of
+    # later RCs are aligned to that header, datasets an RC could not load are left empty
+    if not os.path.exists(points_file):
+        table.to_csv(points_file, index=False)
+        return
+    columns = pd.read_csv(points_file, nrows=0).columns
+    new_columns = [column for column in table.columns if column not in columns]
+    if len(new_columns) > 0:
+        # datasets missing in the first RCs, the file is rewritten once with the columns added
+        print(f"Adding columns {new_columns} to {points_file}.")
+        pd.concat([pd.read_csv(points_file), table]).to_csv(points_file, index=False)
+        return
+    table.reindex(columns=columns).to_csv(points_file, mode="a", header=False, index=False)
 
 
 def main_fci(input_dir, datasets, start_time, end_time, lonlat_bbox, output_dir, run_name,
              remote_files=False,
-             process_RC_every_minutes=10):
+             process_RC_every_minutes=10,
+             remote_read_mode="simplecache",
+             n_workers=1,
+             n_dask_threads=None,
+             writer_kwargs=None,
+             output_format="geotiff",
+             points=None):
+    # n_workers > 1 processes the RCs in parallel in that many processes, each computing with n_dask_threads
+    # dask threads (by default the cores shared out between the workers, or dask's default of one per core for a
+    # single worker). A failing RC is reported and the others go on.
+    # writer_kwargs are passed to the GeoTIFF writer, DEFAULT_WRITER_KWARGS if None. With output_format "zarr",
+    # the RCs already in the cubes of all datasets are skipped, so that an interrupted run can be resumed.
+    # points, a DataFrame with longitude and latitude columns (e.g. FIRMS detections), switches to sampling the
+    # datasets at the points instead of writing images. The values are streamed to POINTS_FILENAME in output_dir.
+    # lonlat_bbox can also be a dict of bboxes by AOI name, e.g. for several fire events of the same period. Each
+    # RC is then loaded once for all AOIs and written to the folder of each AOI, named like a run after the AOI
     # Convert start and end times to datetime objects
     start_dt = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S")
     end_dt = datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%S")
 
+    if isinstance(lonlat_bbox, dict):
+        aois = lonlat_bbox
+    else:
+        aois = {run_name: lonlat_bbox}
+    aoi_outputs = [(aoi_bbox, os.path.join(output_dir, aoi_name, 'Satellite_Imagery', 'FCI'))
+                   for aoi_name, aoi_bbox in aois.items()]
     output_dir = os.path.join(output_dir, run_name, 'Satellite_Imagery', 'FCI')
+    if remote_read_mode not in REMOTE_READ_MODES:
+        raise ValueError(f"Unknown remote read mode {remote_read_mode}, choose from {REMOTE_READ_MODES}.")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, choose from {OUTPUT_FORMATS}.")
+    if output_format == "zarr" and n_workers > 1:
+        raise ValueError("The zarr cubes are appended to by a single process, use n_workers=1.")
+    # the workers of a parallel run have their own caches
+    use_bucket_cache = remote_files and remote_read_mode == "simplecache" and n_workers == 1
+    bucket_cache = BucketCache(CACHE_FOLDER, CACHE_SIZE_LIMIT_GB) if use_bucket_cache else None
+    if remote_files and remote_read_mode == "simplecache":
+        remove_stale_worker_caches(CACHE_FOLDER, n_workers if n_workers > 1 else 0)
+
+    # one filesystem for the whole run, None reads the local files directly
+    fs = create_filesystem(remote_read_mode, bucket_cache) if remote_files else None
+    clear_blocks = remote_files and remote_read_mode == "blockcache"
+    if clear_blocks:
+        # blocks left by an interrupted run, including those of the workers
+        fs.clear_cache()
+
+    # only the chunks overlapping the bbox, or holding the points, are opened, the others are never needed
+    if points is not None:
+        chunks = get_chunks_for_lon_lat_points(points['longitude'].values, points['latitude'].values)
+        if len(chunks) == 0:
+            raise ValueError("All points are outside the FCI full disk.")
+    else:
+        # the union of the chunks of all AOIs
+        chunks = sorted(set(chunk for aoi_bbox in aois.values() for chunk in get_chunks_for_lon_lat_bbox(aoi_bbox)))
+    input_files = list_input_files(input_dir, fs)
+    time_index = get_time_index(input_files, chunks)
+    print(f"Listed {len(input_files)} files in {input_dir}, {len(time_index)} of them for chunks {chunks}")
+
+    cube_times = []
+    if output_format == "zarr":
+        cube_times = [get_cube_times(get_cube_path(aoi_output_dir, dataset))
+                      for _, aoi_output_dir in aoi_outputs for dataset in datasets]
+
     # Iterate through each 10-minute interval between start and end times
+    rcs = []
     current_dt = start_dt
     while current_dt <= end_dt:
-        print(f"Processing {current_dt}...")
-        if not remote_files:
-            fci_filenames = find_files_and_readers(base_dir=input_dir,
-                                                   start_time=current_dt,
-                                                   end_time=current_dt + timedelta(minutes=10),
-                                                   reader='fci_l1c_nc',
-                                                   missing_ok=True)
-        else:
-            fs = fsspec.filesystem(
-                "simplecache",
-                target_protocol="s3",
-                target_options={
-                    "endpoint_url": credentials.S3_ENDPOINT,
-                    "key": credentials.S3_NERO_ACCESS_KEY,
-                    "secret": credentials.S3_NERO_SECRET_KEY,
-                },
-
-                cache_storage=CACHE_FOLDER
-            )
-
-            fci_filenames = find_files_and_readers(base_dir=f"s3://{credentials.S3_NERO_BUCKET_NAME}/{input_dir}",
-                                                   start_time=current_dt,
-                                                   end_time=current_dt + timedelta(minutes=10),
-                                                   reader='fci_l1c_nc',
-                                                   fs=fs,
-                                                   missing_ok=True)
-
-        if 'fci_l1c_nc' in fci_filenames and len(fci_filenames['fci_l1c_nc']) > 0:
-            print(f"Found {len(fci_filenames['fci_l1c_nc'])} filenames")
-
-            # manually create FSFiles for each found path and pass that to the Scene
-            fci_filenames['fci_l1c_nc'] = [FSFile(fn, fs=fs) for fn in fci_filenames['fci_l1c_nc']]
-
-            run_satpy_for_files_and_area(fci_filenames, datasets, lonlat_bbox, output_dir)
-            clear_cache_if_exceeds_limit(CACHE_FOLDER, CACHE_SIZE_LIMIT_GB)
+        filenames = [entry.name for entry in time_index.select(current_dt, current_dt + timedelta(minutes=10))]
+        if output_format == "zarr" and is_rc_in_cubes(current_dt, current_dt + timedelta(minutes=10), cube_times):
+            print(f"Skipping RC {current_dt}, it is in the cubes already.")
+        elif len(filenames) > 0:
+            rcs.append((current_dt, filenames))
         else:
-            print("Skipping RC due to missing input files.")
-
+            print(f"Skipping RC {current_dt} due to missing input files.")
         current_dt += timedelta(minutes=process_RC_every_minutes)
 
+    points_file = os.path.join(output_dir, POINTS_FILENAME)
+    if points is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(points_file):
+            os.remove(points_file)
+
+    failed_rcs = []
+    worker_cache_stats = {}
+    if n_workers > 1:
+        if n_dask_threads is None:
+            # dask would start one thread per core in each worker
+            n_dask_threads = max(1, os.cpu_count() // n_workers)
+        # the workers are spawned rather than forked, forking a process running dask threads is not safe
+        mp_context = get_context("spawn")
+        worker_indices = mp_context.Queue()
+        for worker_index in range(n_workers):
+            worker_indices.put(worker_index)
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, initializer=init_rc_worker,
+                                 initargs=(remote_files, remote_read_mode, n_dask_threads, worker_indices,
+                                           n_workers)) as executor:
+            futures = [(rc_dt, executor.submit(process_rc_in_worker, filenames, datasets, aoi_outputs, writer_kwargs,
+                                               points))
+                       for rc_dt, filenames in rcs]
+            # results are reported in RC order, the output filenames only depend on the RC
+            for rc_dt, future in futures:
+                try:
+                    table, worker_index, cache_stats = future.result()
+                    if cache_stats is not None:
+                        # the RCs of a worker are processed in submission order, the latest stats are the newest
+                        worker_cache_stats[worker_index] = cache_stats
+                    if table is not None:
+                        append_points_table(table, points_file)
+                    print(f"Processed {rc_dt}")
+                except Exception as error:
+                    print(f"Processing {rc_dt} failed: {error}")
+                    failed_rcs.append(rc_dt)
+    else:
+        if n_dask_threads is not None:
+            dask.config.set(scheduler='threads', num_workers=n_dask_threads)
+        for rc_dt, filenames in rcs:
+            print(f"Processing {rc_dt}...")
+            print(f"Found {len(filenames)} filenames")
+            try:
+                table = process_rc(filenames, datasets, aoi_outputs, fs=fs, bucket_cache=bucket_cache,
+                                   writer_kwargs=writer_kwargs, output_format=output_format, points=points,
+                                   clear_blocks=clear_blocks)
+                if table is not None:
+                    append_points_table(table, points_file)
+            except Exception:
+                traceback.print_exc()
+                print(f"Processing {rc_dt} failed.")
+                failed_rcs.append(rc_dt)
+
+    print(f"Processed {len(rcs) - len(failed_rcs)} RCs, {len(failed_rcs)} failed.")
+    for rc_dt in failed_rcs:
+        print(f"Failed RC: {rc_dt}")
+    if bucket_cache is not None:
+        bucket_cache.print_stats()
+    if len(worker_cache_stats) > 0:
+        print_cache_stats(combine_stats(list(worker_cache_stats.values())))
+
 
 if __name__ == "__main__":
     # should be a full 10-min time, like :00, :10, :20...
@@ -129,10 +583,22 @@ if __name__ == "__main__":
     E = -7.0
     N = 41.2
     lonlat_bbox = [W, S, E, N]
+    # or a dict of bboxes by AOI name, to process several AOIs in a single pass over the inputs
+    # lonlat_bbox = {"aveiro_penalva": [W, S, E, N], "evros": [25.8, 40.8, 26.4, 41.2]}
 
     input_dir = '/tcenas/scratch/andream/sepeumdac/fci_l1c_input_data/'
     # input_dir = 'satellite_data/fci_data/202409_Portugal/'
     remote_files = False
+    # with remote_files, "blockcache" only transfers the parts of the files that are read
+    remote_read_mode = "simplecache"
+    # number of processes working on RCs in parallel, and dask threads per process
+    n_workers = 1
+    n_dask_threads = None
+    # "zarr" appends the RCs to a time cube per dataset instead of writing GeoTIFFs
+    output_format = "geotiff"
+    # a DataFrame with longitude and latitude columns, e.g. FIRMS detections, samples the datasets at these points
+    # to a CSV table instead of writing images
+    points = None
 
     run_name = "aveiro_penalva"
     output_dir = './ref_data/'
@@ -141,4 +607,9 @@ if __name__ == "__main__":
 
     main_fci(input_dir, datasets, start_time, end_time, lonlat_bbox, output_dir, run_name,
              remote_files=remote_files,
-             process_RC_every_minutes=10)
+             process_RC_every_minutes=10,
+             remote_read_mode=remote_read_mode,
+             n_workers=n_workers,
+             n_dask_threads=n_dask_threads,
+             output_format=output_format,
+             points=points)
@@ -11,7 +11,23 @@
 # You should have received a copy of the GNU General Public License along with this program.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from satpy.resample import get_area_def
+from bisect import bisect_left
+from functools import lru_cache
+
+import numpy as np
+
+# geostationary projection of the 1 km FCI full disk grid, as in satpy's 'mtg_fci_fdss_1km' area
+FCI_AREA_NAME = 'mtg_fci_fdss_1km'
+FCI_SATELLITE_HEIGHT = 35786400.
+FCI_SEMI_MAJOR_AXIS = 6378137.
+FCI_SEMI_MINOR_AXIS = 6356752.314245179
+FCI_N_ROWS = 11136
+FCI_AREA_EXTENT = (-5567999.998550739, -5567999.998550739, 5567999.998550762, 5567999.998550762)
+FCI_PIXEL_SIZE = (FCI_AREA_EXTENT[3] - FCI_AREA_EXTENT[1]) / FCI_N_ROWS
+
+# number of points sampled along each edge of a bbox or polygon, the northern- or southernmost
+# row of an area is not always at one of its corners
+N_EDGE_SAMPLES = 100
 
 end_position_rows = [278,
                      556,
@@ -56,30 +72,94 @@ end_position_rows = [278,
 
 
 def get_first_index_bigger_than(value, sorted_list):
-    for index, item in enumerate(sorted_list):
-        if item >= value:
-            return index + 1
+    index = bisect_left(sorted_list, value)
+    if index < len(sorted_list):
+        return index + 1
     return -1
 
 
+@lru_cache(maxsize=None)
+def get_fci_area_def():
+    # satpy is slow to import, it is only loaded when the area definition itself is needed
+    from satpy.area import get_area_def
+    return get_area_def(FCI_AREA_NAME)
+
+
+def get_rows_for_lon_lat(lons, lats, use_satpy=False):
+    """Get the rows of the 1 km FCI grid (counted from the north) for arrays of lon/lat points.
+
+    Points outside the Earth disk seen by FCI are returned as NaN.
+    """
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    if use_satpy:
+        _, rows = get_fci_area_def().get_array_indices_from_lonlat(lons, lats)
+        return np.ma.filled(np.ma.masked_array(rows, dtype=float), np.nan)
+
+    # forward geostationary projection (sweep y), with lengths normalised by the semi-major axis
+    radius_p2 = (FCI_SEMI_MINOR_AXIS / FCI_SEMI_MAJOR_AXIS) ** 2
+    radius_g = 1 + FCI_SATELLITE_HEIGHT / FCI_SEMI_MAJOR_AXIS
+    lon = np.radians(lons)
+    lat = np.arctan(radius_p2 * np.tan(np.radians(lats)))
+    radius = np.sqrt(radius_p2) / np.hypot(np.sqrt(radius_p2) * np.cos(lat), np.sin(lat))
+    vx = radius * np.cos(lon) * np.cos(lat)
+    vy = radius * np.sin(lon) * np.cos(lat)
+    vz = radius * np.sin(lat)
+    tmp = radius_g - vx
+    visible = (tmp * vx - vy ** 2 - vz ** 2 / radius_p2) >= 0
+    y = FCI_SATELLITE_HEIGHT * np.arctan(vz / np.hypot(vy, tmp))
+
+    rows = np.round((FCI_AREA_EXTENT[3] - FCI_PIXEL_SIZE / 2 - y) / FCI_PIXEL_SIZE)
+    return np.where(visible, np.clip(rows, 0, FCI_N_ROWS - 1), np.nan)
+
+
+def get_chunks_for_rows(rows):
+    # chunks are numbered from the south, end_position_rows holds their last row counted from the south
+    rows = np.asarray(rows, dtype=float)
+    rows = rows[~np.isnan(rows)]
+    chunks = np.searchsorted(end_position_rows, FCI_N_ROWS - rows, side='left') + 1
+    return chunks[chunks <= len(end_position_rows)]
+
+
 def get_chunk_for_lon_lat(lon, lat):
-    fci_area = get_area_def('mtg_fci_fdss_1km')
-    _, row = fci_area.get_array_indices_from_lonlat(lon, lat)
-    index = get_first_index_bigger_than(11136 - row, end_position_rows)
+    row = get_rows_for_lon_lat(lon, lat)
+    if np.isnan(row):
+        raise ValueError(f"Point ({lon}, {lat}) is outside the FCI full disk.")
+    index = get_first_index_bigger_than(FCI_N_ROWS - int(row), end_position_rows)
     return index
 
 
+def get_chunks_for_lon_lat_points(lons, lats):
+    """Get the sorted list of chunks containing any of the given lon/lat points."""
+    return sorted(set(get_chunks_for_rows(get_rows_for_lon_lat(lons, lats)).tolist()))
+
+
+def densify_polygon(lons, lats, n_edge_samples=N_EDGE_SAMPLES):
+    # closes the polygon and samples n_edge_samples points along each of its edges
+    lons = np.append(lons, lons[0])
+    lats = np.append(lats, lats[0])
+    steps = np.linspace(0, 1, n_edge_samples, endpoint=False)
+    dense_lons = (lons[:-1, None] + np.diff(lons)[:, None] * steps).ravel()
+    dense_lats = (lats[:-1, None] + np.diff(lats)[:, None] * steps).ravel()
+    return dense_lons, dense_lats
+
+
+def get_chunks_for_lon_lat_polygon(lons, lats):
+    """Get the gap free list of chunks covering a lon/lat polygon, given by the lons/lats of its vertices."""
+    chunks = get_chunks_for_lon_lat_points(*densify_polygon(np.asarray(lons, dtype=float),
+                                                            np.asarray(lats, dtype=float)))
+    if len(chunks) == 0:
+        raise ValueError("Area is outside the FCI full disk.")
+    return list(range(min(chunks), max(chunks) + 1))  # Make the chunks gap free
+
+
 def get_chunks_for_lon_lat_bbox(lonlat_bbox: list[float] | None) -> list[int]:
     if lonlat_bbox is None:
         chunks = list(range(1, 41))
         return chunks
     else:
-        chunks = []
-        chunks.append(get_chunk_for_lon_lat(lonlat_bbox[0], lonlat_bbox[1]))
-        chunks.append(get_chunk_for_lon_lat(lonlat_bbox[0], lonlat_bbox[3]))
-        chunks.append(get_chunk_for_lon_lat(lonlat_bbox[2], lonlat_bbox[1]))
-        chunks.append(get_chunk_for_lon_lat(lonlat_bbox[2], lonlat_bbox[3]))
-        chunks = list(range(min(chunks), max(chunks) + 1))  # Make the chunks gap free
+        west, south, east, north = lonlat_bbox
+        chunks = get_chunks_for_lon_lat_polygon([west, west, east, east], [south, north, north, south])
     return chunks
 
 
@@ -11,52 +11,146 @@
 # You should have received a copy of the GNU General Public License along with this program.
 # If not, see <https://www.gnu.org/licenses/>.
 import fnmatch
+import hashlib
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 import credentials
 
+MB = 1024 ** 2
+# files bigger than this are transferred in parts of MULTIPART_CHUNK_SIZE, several parts at a time
+MULTIPART_THRESHOLD = 8 * MB
+MULTIPART_CHUNK_SIZE = 8 * MB
+N_PARALLEL_FILES = 8
+N_PARALLEL_PARTS = 8
+# part sizes commonly used by S3 clients, to recompute the ETag of multipart uploads
+COMMON_PART_SIZES = (8 * MB, 5 * MB, 16 * MB, 15 * MB, 64 * MB)
 
-def download_from_bucket(prefixes, local_download_dir, file_pattern_to_download):
-    # Initialize S3 client
-    s3 = boto3.client(
+
+def create_s3_client(endpoint_url=None, max_pool_connections=N_PARALLEL_FILES * N_PARALLEL_PARTS):
+    # one client shared by all transfers, with a connection pool big enough for all of them
+    return boto3.client(
         "s3",
-        endpoint_url=credentials.S3_ENDPOINT,
+        endpoint_url=endpoint_url or credentials.S3_ENDPOINT,
         aws_access_key_id=credentials.S3_NERO_ACCESS_KEY,
         aws_secret_access_key=credentials.S3_NERO_SECRET_KEY,
+        config=Config(max_pool_connections=max_pool_connections),
     )
+
+
+def get_transfer_config(n_parallel_parts=N_PARALLEL_PARTS):
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                          max_concurrency=n_parallel_parts, use_threads=True)
+
+
+def list_objects(s3, bucket_name, prefix):
+    # list_objects_v2 returns at most 1000 keys per call, the paginator follows the continuation tokens
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def get_etag(file_path, part_size=None):
+    # ETag of a file as computed by S3: the MD5 of the file, or for multipart uploads the MD5 of the
+    # concatenated MD5s of the parts followed by the number of parts
+    if part_size is None:
+        checksum = hashlib.md5()
+        with open(file_path, "rb") as f:
+            for buffer in iter(lambda: f.read(MULTIPART_CHUNK_SIZE), b""):
+                checksum.update(buffer)
+        return checksum.hexdigest()
+    part_digests = []
+    with open(file_path, "rb") as f:
+        for buffer in iter(lambda: f.read(part_size), b""):
+            part_digests.append(hashlib.md5(buffer).digest())
+    return hashlib.md5(b"".join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def is_unchanged(file_path, size, etag):
+    # compares a local file with the size and ETag of an object
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+        return False
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return get_etag(file_path) == etag
+    # the part size of a multipart upload is not stored, try the usual ones and the one matching the part count
+    n_parts = int(etag.split("-")[-1])
+    part_sizes = set(COMMON_PART_SIZES)
+    part_sizes.add(-(-size // n_parts // MB) * MB)
+    for part_size in sorted(part_sizes):
+        if part_size > 0 and -(-size // part_size) == n_parts and get_etag(file_path, part_size) == etag:
+            return True
+    return False
+
+
+def download_from_bucket(prefixes, local_download_dir, file_pattern_to_download, s3=None, bucket_name=None,
+                         n_parallel_files=N_PARALLEL_FILES, n_parallel_parts=N_PARALLEL_PARTS):
+    # Syncs the objects under the prefixes matching the file pattern to the local folder, only downloading the
+    # objects that are missing or differ in size or ETag. s3 and bucket_name default to the NERO bucket, another
+    # client can be passed in, e.g. for a local S3 server
+    if s3 is None:
+        s3 = create_s3_client(max_pool_connections=n_parallel_files * n_parallel_parts)
+    bucket_name = bucket_name or credentials.S3_NERO_BUCKET_NAME
+    transfer_config = get_transfer_config(n_parallel_parts)
     if isinstance(prefixes, str):
         prefixes = [prefixes]
 
+    to_download = []
+    n_unchanged = 0
     for prefix in prefixes:
         if not prefix.endswith("/"):
             prefix += "/"
 
         print(f"Searching in {prefix}")
-        # List objects under the specified prefixes
-        response = s3.list_objects_v2(Bucket=credentials.S3_NERO_BUCKET_NAME, Prefix=prefix)
-        # Check if there are files under the prefixes
-        if "Contents" in response:
-            for obj in response["Contents"]:
-                file_key = obj["Key"]  # Full S3 file path
-                file_name = os.path.basename(file_key)
-
-                # Check if the file_name matches the provided file pattern
-                if fnmatch.fnmatch(file_name, file_pattern_to_download):
-                    local_file_path = os.path.join(local_download_dir, file_key.replace(prefix, ""))
-
-                    # Ensure subdirectories exist locally
-                    os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-
-                    # Download the file
-                    print(f"Downloading {file_key} to {local_file_path}")
-                    s3.download_file(credentials.S3_NERO_BUCKET_NAME, file_key, local_file_path)
-
-            print("All files matching the filepattern downloaded successfully!")
-        else:
+        n_found = 0
+        for obj in list_objects(s3, bucket_name, prefix):
+            file_key = obj["Key"]  # Full S3 file path
+            file_name = os.path.basename(file_key)
+
+            # Check if the file_name matches the provided file pattern
+            if not file_key.endswith("/") and fnmatch.fnmatch(file_name, file_pattern_to_download):
+                n_found += 1
+                local_file_path = os.path.join(local_download_dir, file_key[len(prefix):])
+                if is_unchanged(local_file_path, obj["Size"], obj["ETag"]):
+                    n_unchanged += 1
+                else:
+                    to_download.append((file_key, local_file_path, obj["Size"]))
+        if n_found == 0:
             print("No files found under", prefix)
 
+    def download(file_key, local_file_path):
+        # Ensure subdirectories exist locally
+        os.makedirs(os.path.dirname(local_file_path) or ".", exist_ok=True)
+        s3.download_file(bucket_name, file_key, local_file_path, Config=transfer_config)
+
+    print(f"Downloading {len(to_download)} files, {n_unchanged} files are up to date.")
+    start_time = time.monotonic()
+    n_failed = 0
+    n_bytes = 0
+    with ThreadPoolExecutor(max_workers=n_parallel_files) as executor:
+        futures = {executor.submit(download, file_key, local_file_path): (file_key, local_file_path, size)
+                   for file_key, local_file_path, size in to_download}
+        for future in as_completed(futures):
+            file_key, local_file_path, size = futures[future]
+            try:
+                future.result()
+                n_bytes += size
+                print(f"Downloaded {file_key} to {local_file_path}")
+            except Exception as error:
+                print(f"Failed to download {file_key}: {error}")
+                n_failed += 1
+
+    duration_s = time.monotonic() - start_time
+    print(f"Downloaded {len(to_download) - n_failed} files ({n_bytes / MB:.1f} MB) in {duration_s:.1f} s, "
+          f"{n_failed} failed.")
+    if n_failed == 0:
+        print("All files matching the filepattern downloaded successfully!")
+
 
 if __name__ == "__main__":
     prefixes_to_download = "testfolder/"  # Folder prefixes (e.g., "folder/subfolder/" or a list thereof)
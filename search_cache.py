@@ -0,0 +1,93 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+SEARCH_CACHE_FOLDER = "./search_cache/"
+# windows that may still receive new products are only trusted for a short time
+OPEN_WINDOW_TTL_S = 10 * 60
+# closed historical windows do not change anymore, None means they never expire
+CLOSED_WINDOW_TTL_S = None
+# time after the end of a window during which products can still be disseminated
+DISSEMINATION_DELAY = timedelta(hours=6)
+
+
+class SearchCache:
+    """On-disk cache of product searches, keyed by collection id, time range and bbox.
+
+    Each cached search stores the product type and the product ids with their entry lists (once known).
+    Searches over windows that ended more than DISSEMINATION_DELAY before they were cached are considered
+    closed and use closed_window_ttl_s, all others use open_window_ttl_s.
+    """
+
+    def __init__(self, cache_folder=SEARCH_CACHE_FOLDER, open_window_ttl_s=OPEN_WINDOW_TTL_S,
+                 closed_window_ttl_s=CLOSED_WINDOW_TTL_S, dissemination_delay=DISSEMINATION_DELAY):
+        self.cache_folder = cache_folder
+        self.open_window_ttl_s = open_window_ttl_s
+        self.closed_window_ttl_s = closed_window_ttl_s
+        self.dissemination_delay = dissemination_delay
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def get_cache_file(self, collection_id, start_time, end_time, search_bbox):
+        key = json.dumps([collection_id, start_time, end_time, search_bbox])
+        return os.path.join(self.cache_folder, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def is_expired(self, record):
+        end_time = datetime.strptime(record['end_time'], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+        saved_at = datetime.fromtimestamp(record['saved_at'], tz=timezone.utc)
+        if saved_at > end_time + self.dissemination_delay:
+            ttl_s = self.closed_window_ttl_s
+        else:
+            ttl_s = self.open_window_ttl_s
+        return ttl_s is not None and time.time() - record['saved_at'] > ttl_s
+
+    def load(self, collection_id, start_time, end_time, search_bbox):
+        cache_file = self.get_cache_file(collection_id, start_time, end_time, search_bbox)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError) as error:
+            logger.info(f"Ignoring unreadable search cache file {cache_file}: {error}")
+            return None
+        if self.is_expired(record):
+            logger.debug(f"Search cache for collection {collection_id} expired.")
+            return None
+        return record
+
+    def save(self, collection_id, start_time, end_time, search_bbox, product_type, product_entries,
+             saved_at=None):
+        record = {
+            'collection_id': collection_id,
+            'start_time': start_time,
+            'end_time': end_time,
+            'search_bbox': search_bbox,
+            'product_type': product_type,
+            'saved_at': time.time() if saved_at is None else saved_at,
+            # list of [product_id, entries], entries are None until they have been listed
+            'products': product_entries,
+        }
+        cache_file = self.get_cache_file(collection_id, start_time, end_time, search_bbox)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(record, f)
+        os.replace(cache_file + ".tmp", cache_file)
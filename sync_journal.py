@@ -0,0 +1,139 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+SYNC_JOURNAL_FILENAME = ".sync_journal.sqlite"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+# done entries whose file went missing, until they are downloaded again
+STATUS_PENDING = "pending"
+
+
+class SyncJournal:
+    """SQLite manifest of a download run, with one row per product entry.
+
+    Rows hold the status of the last download attempt together with the file size, MD5 checksum,
+    download duration and error message, so that re-runs only schedule missing or failed entries.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # the journal is written from the download threads, access is serialised with the lock
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "collection_id TEXT NOT NULL, "
+                "product_id TEXT NOT NULL, "
+                "entry TEXT NOT NULL, "
+                "output_file TEXT, "
+                "status TEXT NOT NULL, "
+                "size INTEGER, "
+                "checksum TEXT, "
+                "duration_s REAL, "
+                "error TEXT, "
+                "updated_at REAL, "
+                "PRIMARY KEY (collection_id, product_id, entry))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS high_water_marks ("
+                "collection_id TEXT PRIMARY KEY, "
+                "sensing_time TEXT NOT NULL)")
+
+    @classmethod
+    def for_run_folder(cls, output_folder_run):
+        return cls(os.path.join(output_folder_run, SYNC_JOURNAL_FILENAME))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(self, collection_id, product_id, entry, output_file, status, size=None, checksum=None,
+               duration_s=None, error=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (collection_id, product_id, entry, output_file, status, size, checksum, duration_s, error,
+                 time.time()))
+
+    def get_high_water_mark(self, collection_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sensing_time FROM high_water_marks WHERE collection_id = ?", (collection_id,)).fetchone()
+        return datetime.strptime(row[0], "%Y-%m-%dT%H:%M:%S.%f") if row is not None else None
+
+    def set_high_water_mark(self, collection_id, sensing_time):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO high_water_marks VALUES (?, ?)",
+                (collection_id, sensing_time.strftime("%Y-%m-%dT%H:%M:%S.%f")))
+
+    def get_done_entries(self, collection_id):
+        # recorded file size by (product id, entry)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT product_id, entry, size FROM entries WHERE collection_id = ? AND status = ?",
+                (collection_id, STATUS_DONE)).fetchall()
+        return {(product_id, entry): size for product_id, entry, size in rows}
+
+    def get_failed_entries(self, collection_id=None):
+        query = "SELECT collection_id, product_id, entry, output_file, error FROM entries WHERE status = ?"
+        params = (STATUS_FAILED,)
+        if collection_id is not None:
+            query += " AND collection_id = ?"
+            params += (collection_id,)
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def get_throughput_report(self, collection_id=None):
+        query = ("SELECT collection_id, "
+                 "SUM(status = 'done'), SUM(status = 'failed'), "
+                 "SUM(CASE WHEN status = 'done' THEN size ELSE 0 END), "
+                 "SUM(CASE WHEN status = 'done' THEN duration_s ELSE 0 END) "
+                 "FROM entries")
+        params = ()
+        if collection_id is not None:
+            query += " WHERE collection_id = ?"
+            params = (collection_id,)
+        query += " GROUP BY collection_id"
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+
+        report = {}
+        for collection_id, n_done, n_failed, n_bytes, duration_s in rows:
+            n_bytes = n_bytes or 0
+            report[collection_id] = {
+                'n_done': n_done or 0,
+                'n_failed': n_failed or 0,
+                'size_mb': n_bytes / 1024 ** 2,
+                # throughput of a single download stream, the overall rate scales with the parallel downloads
+                'mb_per_s': n_bytes / 1024 ** 2 / duration_s if duration_s else None,
+            }
+        return report
+
+    def log_throughput_report(self, collection_id=None):
+        for collection_id, stats in self.get_throughput_report(collection_id).items():
+            throughput = f"{stats['mb_per_s']:.2f} MB/s per download" if stats['mb_per_s'] is not None else "n/a"
+            logger.info(f"Collection {collection_id}: {stats['n_done']} files done ({stats['size_mb']:.1f} MB, "
+                        f"{throughput}), {stats['n_failed']} failed.")
@@ -12,17 +12,141 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import shutil
+import subprocess
+import tarfile
+import threading
 import zipfile
 
+from sync_journal import SYNC_JOURNAL_FILENAME
+
+# formats that are compressed already, compressing them again costs time for (almost) no gain
+ALREADY_COMPRESSED_SUFFIXES = ('.nc', '.nc4', '.h5', '.tif', '.tiff', '.png', '.jpg', '.jpeg', '.jp2', '.zip', '.gz',
+                               '.tgz', '.bz2', '.xz', '.zst', '.zarr')
+# external tools compressing tarballs on all cores, per compression
+PARALLEL_COMPRESSORS = {
+    'gz': ['pigz', '-p', '{n_threads}', '-c'],
+    'zst': ['zstd', '-T{n_threads}', '-q', '-c'],
+}
+# files that are never archived: partial downloads
+SKIPPED_SUFFIXES = ('.part',)
+# and the download journal of the run, with the rollback journal SQLite writes next to it
+SKIPPED_NAMES = (SYNC_JOURNAL_FILENAME, SYNC_JOURNAL_FILENAME + '-journal')
+
+
+def is_skipped(file_path):
+    return file_path.endswith(SKIPPED_SUFFIXES) or os.path.basename(file_path) in SKIPPED_NAMES
+
+
+def get_zip_compress_type(filename):
+    if filename.lower().endswith(ALREADY_COMPRESSED_SUFFIXES):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def is_unchanged(zip_info, file_path):
+    # zip files store the modification time with a resolution of two seconds, rounded down to an even second
+    file_info = zipfile.ZipInfo.from_file(file_path)
+    date_time = file_info.date_time[:5] + (file_info.date_time[5] // 2 * 2,)
+    return zip_info.file_size == file_info.file_size and tuple(zip_info.date_time) == date_time
+
+
+def zip_output_folder(folder_to_zip, output_filename, update=True):
+    file_paths = {}
+    for root, dirs, files in os.walk(folder_to_zip):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if os.path.abspath(file_path) != os.path.abspath(output_filename) and not is_skipped(file):
+                file_paths[os.path.relpath(file_path, folder_to_zip)] = file_path
+
+    mode = 'w'
+    if update and os.path.exists(output_filename):
+        with zipfile.ZipFile(output_filename) as zipf:
+            archived = {info.filename: info for info in zipf.infolist()}
+        # members cannot be replaced in a zip file, if any file changed or was removed the zip is rebuilt
+        if all(arcname in file_paths and is_unchanged(info, file_paths[arcname]) for arcname, info in archived.items()):
+            file_paths = {arcname: path for arcname, path in file_paths.items() if arcname not in archived}
+            mode = 'a'
+
+    if mode == 'a' and len(file_paths) == 0:
+        print(f"Zip file {output_filename} is up to date")
+        return
 
-def zip_output_folder(folder_to_zip, output_filename):
     print(f"Zipping folder {folder_to_zip} to {output_filename}")
-    with zipfile.ZipFile(output_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(folder_to_zip):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, folder_to_zip)
-                zipf.write(file_path, arcname)
+    with zipfile.ZipFile(output_filename, mode, zipfile.ZIP_DEFLATED) as zipf:
+        for arcname, file_path in file_paths.items():
+            zipf.write(file_path, arcname, compress_type=get_zip_compress_type(file_path))
 
     print(f"Generated zip file: {output_filename}")
     return
+
+
+class TarArchiver:
+    """Writes files to a tarball as soon as they are added, e.g. while they are downloaded.
+
+    With compression 'gz' or 'zst', the tar stream is compressed on all cores by pigz or zstd when they are
+    installed (falling back to single-threaded gzip for 'gz'). Without compression, an existing tarball is
+    updated incrementally, only adding files that are not in it yet.
+    """
+
+    def __init__(self, tarball_path, root_folder, compression='gz', n_threads=None):
+        self.tarball_path = tarball_path
+        self.root_folder = root_folder
+        self.lock = threading.Lock()
+        self.process = None
+        self.output = None
+        self.archived = set()
+        n_threads = n_threads or os.cpu_count()
+
+        if compression not in (None, *PARALLEL_COMPRESSORS):
+            raise ValueError(f"Unknown compression {compression}, choose from None, {list(PARALLEL_COMPRESSORS)}.")
+        if compression is None:
+            if os.path.exists(tarball_path):
+                with tarfile.open(tarball_path, 'r') as tar:
+                    self.archived = {(member.name, member.size, int(member.mtime)) for member in tar.getmembers()}
+            self.tar = tarfile.open(tarball_path, 'a')
+        elif compression in PARALLEL_COMPRESSORS and shutil.which(PARALLEL_COMPRESSORS[compression][0]):
+            command = [arg.format(n_threads=n_threads) for arg in PARALLEL_COMPRESSORS[compression]]
+            self.output = open(tarball_path, 'wb')
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.output)
+            self.tar = tarfile.open(fileobj=self.process.stdin, mode='w|')
+        elif compression == 'gz':
+            self.tar = tarfile.open(tarball_path, 'w:gz')
+        else:
+            raise ValueError(f"Compression {compression} needs {PARALLEL_COMPRESSORS[compression][0]} to be installed.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_arcname(self, file_path):
+        return os.path.join(os.path.basename(os.path.normpath(self.root_folder)),
+                            os.path.relpath(file_path, self.root_folder))
+
+    def add(self, file_path):
+        if os.path.abspath(file_path) == os.path.abspath(self.tarball_path) or is_skipped(file_path):
+            return
+        arcname = self.get_arcname(file_path)
+        stat = os.stat(file_path)
+        key = (arcname, stat.st_size, int(stat.st_mtime))
+        with self.lock:
+            if key not in self.archived:
+                self.tar.add(file_path, arcname=arcname, recursive=False)
+                self.archived.add(key)
+
+    def add_folder(self, folder):
+        for root, dirs, files in os.walk(folder):
+            for file in sorted(files):
+                self.add(os.path.join(root, file))
+
+    def close(self):
+        with self.lock:
+            self.tar.close()
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.output.close()
+                if self.process.returncode != 0:
+                    raise RuntimeError(f"Compression of {self.tarball_path} failed.")
@@ -0,0 +1,145 @@
+# Copyright (C) 2025 EUMETSAT
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+import fnmatch
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import credentials
+from read_bucket_script import (MB, N_PARALLEL_FILES, N_PARALLEL_PARTS, create_s3_client, get_transfer_config,
+                                is_unchanged, list_objects)
+from tools import is_skipped
+
+DEFAULT_POLL_INTERVAL_S = 30
+
+
+def get_object_key(prefix, relative_path):
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return prefix + relative_path.replace(os.sep, "/")
+
+
+def get_local_files(local_folder, prefix, file_pattern):
+    # returns the (local file path, object key) of the files to upload
+    files = []
+    for root, dirs, file_names in os.walk(local_folder):
+        for file_name in sorted(file_names):
+            if is_skipped(file_name) or not fnmatch.fnmatch(file_name, file_pattern):
+                continue
+            file_path = os.path.join(root, file_name)
+            files.append((file_path, get_object_key(prefix, os.path.relpath(file_path, local_folder))))
+    return files
+
+
+def upload_files(s3, bucket_name, files, transfer_config, n_parallel_files=N_PARALLEL_FILES):
+    # uploads (local file path, object key) pairs in parallel, files bigger than the multipart threshold are
+    # uploaded in several parts at a time. Returns the files that were uploaded
+    uploaded = []
+    start_time = time.monotonic()
+    n_bytes = 0
+    with ThreadPoolExecutor(max_workers=n_parallel_files) as executor:
+        futures = {executor.submit(s3.upload_file, file_path, bucket_name, file_key, Config=transfer_config):
+                   (file_path, file_key) for file_path, file_key in files}
+        for future in as_completed(futures):
+            file_path, file_key = futures[future]
+            try:
+                future.result()
+                uploaded.append((file_path, file_key))
+                n_bytes += os.path.getsize(file_path)
+                print(f"Uploaded {file_path} to {file_key}")
+            except Exception as error:
+                print(f"Failed to upload {file_path}: {error}")
+
+    duration_s = time.monotonic() - start_time
+    print(f"Uploaded {len(uploaded)} files ({n_bytes / MB:.1f} MB) in {duration_s:.1f} s, "
+          f"{len(files) - len(uploaded)} failed.")
+    return uploaded
+
+
+def upload_to_bucket(local_folder, prefix, file_pattern="*", s3=None, bucket_name=None,
+                     n_parallel_files=N_PARALLEL_FILES, n_parallel_parts=N_PARALLEL_PARTS):
+    # Uploads the files under local_folder matching the file pattern to the prefix, keeping the directory
+    # structure. Objects whose size and ETag match the local file are skipped. s3 and bucket_name default to the
+    # NERO bucket, another client can be passed in, e.g. for a local S3 server. Returns the files that were
+    # uploaded and the files that were up to date already
+    if s3 is None:
+        s3 = create_s3_client(max_pool_connections=n_parallel_files * n_parallel_parts)
+    bucket_name = bucket_name or credentials.S3_NERO_BUCKET_NAME
+
+    print(f"Comparing {local_folder} with {prefix}")
+    remote_objects = {obj["Key"]: obj for obj in list_objects(s3, bucket_name, prefix)}
+    files = get_local_files(local_folder, prefix, file_pattern)
+    to_upload = []
+    unchanged = []
+    for file_path, file_key in files:
+        obj = remote_objects.get(file_key)
+        if obj is None or not is_unchanged(file_path, obj["Size"], obj["ETag"]):
+            to_upload.append((file_path, file_key))
+        else:
+            unchanged.append((file_path, file_key))
+
+    print(f"Uploading {len(to_upload)} files, {len(unchanged)} files are up to date.")
+    uploaded = upload_files(s3, bucket_name, to_upload, get_transfer_config(n_parallel_parts), n_parallel_files)
+    return uploaded, unchanged
+
+
+def watch_and_upload(local_folder, prefix, file_pattern="*", poll_interval_s=DEFAULT_POLL_INTERVAL_S,
+                     duration_s=None, s3=None, bucket_name=None, n_parallel_files=N_PARALLEL_FILES,
+                     n_parallel_parts=N_PARALLEL_PARTS):
+    # Uploads the output tree while it is being written, e.g. by a main_* function in another process. After an
+    # initial sync, the tree is polled every poll_interval_s and files are uploaded once their size and
+    # modification time did not change between two polls, so that files still being written are not uploaded.
+    # Runs for duration_s seconds, or until interrupted if None
+    if s3 is None:
+        s3 = create_s3_client(max_pool_connections=n_parallel_files * n_parallel_parts)
+    bucket_name = bucket_name or credentials.S3_NERO_BUCKET_NAME
+    transfer_config = get_transfer_config(n_parallel_parts)
+
+    def get_states():
+        states = {}
+        for file_path, file_key in get_local_files(local_folder, prefix, file_pattern):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            states[(file_path, file_key)] = (stat.st_size, stat.st_mtime)
+        return states
+
+    previous_states = get_states()
+    uploaded, unchanged = upload_to_bucket(local_folder, prefix, file_pattern, s3=s3, bucket_name=bucket_name,
+                                           n_parallel_files=n_parallel_files, n_parallel_parts=n_parallel_parts)
+    # files that failed to upload, or appeared during the initial sync, are uploaded by the polls
+    uploaded_states = {file: previous_states[file] for file in uploaded + unchanged if file in previous_states}
+
+    print(f"Watching {local_folder} for new outputs, polling every {poll_interval_s} s.")
+    start_time = time.monotonic()
+    try:
+        while duration_s is None or time.monotonic() - start_time < duration_s:
+            time.sleep(poll_interval_s)
+            states = get_states()
+            to_upload = [file for file, state in states.items()
+                         if state != uploaded_states.get(file) and state == previous_states.get(file)]
+            if len(to_upload) > 0:
+                for file in upload_files(s3, bucket_name, to_upload, transfer_config, n_parallel_files):
+                    uploaded_states[file] = states[file]
+            previous_states = states
+    except KeyboardInterrupt:
+        pass
+    print(f"Stopped watching {local_folder}.")
+
+
+if __name__ == "__main__":
+    run_name = "aveiro_penalva"
+    folder_to_upload = os.path.join("./ref_data/", run_name)
+    prefix_to_upload_to = f"outputs/{run_name}/"
+    upload_to_bucket(folder_to_upload, prefix_to_upload_to)